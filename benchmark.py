@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Benchmarks for the unit parser.
+
+Run all of them with ``python benchmark.py`` or pick some by name, e.g.
+``python benchmark.py prefilter``.
+
+The ``suite`` benchmark runs the main code paths on a seeded synthetic
+corpus and reports throughput and latency percentiles. Save the results
+with ``--save baseline.json`` and check a later run against them with
+``--compare baseline.json``, which fails if anything got slower than the
+threshold.
+
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from collections import OrderedDict
+
+import unit
+from replies import ReplyQueue
+from unit import Unit
+
+
+COMMENTS_WITHOUT_UNITS = [
+    "Nothing to see here, move along.",
+    "This is the best thing I've read all day. Thanks for sharing!",
+    "I have 3 cats and 2 dogs, and all of them hate each other.",
+    "Back in 2015 top 10 lists were all the rage, now it's all 5 second videos.",
+    "Only us true 90's kids played it like that.",
+    "Source? I'd like to read more about this before I believe it.",
+    "they just want to press \"4\", \"3\" maybe \"w\" and win.",
+    "My parents moved here in 1990 in Texas, see page 4, section 2 of the letter.",
+    "Edit: thanks for the gold, kind stranger! " * 4,
+]
+
+COMMENTS_WITH_UNITS = [
+    "I walked 12 miles to have 5 minutes of peace.",
+    "the movie runs for 2 hours and 7 minutes",
+    "my gf is only 4'7\"",
+    "this car makes 859 horse power at the wheels",
+]
+
+
+def bench(name, func, items, repeat=5, batch=False):
+    """
+    Call `func` on every item, or once on all items for a `batch` function,
+    and print the best throughput of `repeat` runs.
+
+    """
+    if batch:
+        timer = timeit.Timer(lambda: func(items))
+    else:
+        timer = timeit.Timer(lambda: [func(item) for item in items])
+    best = min(timer.repeat(repeat=repeat, number=1))
+    print('{:<40} {:>12,.0f} /s'.format(name, len(items) / best))
+
+
+def bench_prefilter():
+    comments = COMMENTS_WITHOUT_UNITS * 1000
+    rejected = [comment for comment in comments if not Unit.may_have_units(comment)]
+    print('prefilter rejects {:.0%} of comments without units'.format(
+        len(rejected) / float(len(comments))))
+
+    bench('may_have_units (rejected comments)', Unit.may_have_units, rejected)
+    bench('find_units (rejected comments)', lambda text: any(Unit.find_units(text)), rejected)
+    bench('may_have_units (comments with units)', Unit.may_have_units,
+          COMMENTS_WITH_UNITS * 1000)
+
+
+def bench_backends():
+    comments = COMMENTS_WITH_UNITS * 1000
+
+    def reply(text):
+        for normal in Unit.find_normalized(text):
+            normal.get_original_string()
+            normal.to_useless()
+
+    for backend in (unit.DECIMAL, unit.FLOAT):
+        unit.set_backend(backend)
+        try:
+            bench('find_normalized + to_useless ({})'.format(backend), reply, comments)
+            values = [normal.value for text in comments for normal in Unit.find_normalized(text)]
+            bench('prettify ({})'.format(backend), unit.prettify, values)
+        finally:
+            unit.set_backend(unit.DECIMAL)
+
+
+def bench_batch():
+    comments = (COMMENTS_WITH_UNITS + COMMENTS_WITHOUT_UNITS) * 1000
+
+    bench('find_normalized (comments)', lambda text: list(Unit.find_normalized(text)), comments)
+    bench('find_units_batch (comments)', Unit.find_units_batch, comments, batch=True)
+
+
+def bench_chains():
+    span = "I waited 1 hour, 3 minutes and 12 seconds, then 5 minutes 7 seconds. "
+
+    for spans in (1, 10, 100, 1000):
+        comments = [span * spans] * max(1, 1000 // spans)
+        bench('find_units ({} time spans)'.format(spans * 2),
+              lambda text: list(Unit.find_units(text)), comments)
+
+
+# pasted tables and spam that made the regex scanner backtrack
+PATHOLOGICAL = OrderedDict([
+    ('thousands', '123,'),
+    ('spaced thousands', '123 '),
+    ('decimals', '1.2.'),
+    ('digits', '9999999999'),
+    ('table', '| 12,345 | 678 | 9.10 |\n'),
+    ('units', '1 mile '),
+])
+
+
+def _regex_scanner():
+    """The unit regex as it was before the number tokenizer, RE_NUM in front of the suffixes."""
+    unit._compile_matcher()
+    regex = re.compile(r'(?=\d)(?=' + unit.RE_NUM + unit.SCANNER.pattern + r')\d+', flags=unit.RE_FLAGS)
+    return lambda text: [match.span() for match in regex.finditer(text) if match.lastindex != 1]
+
+
+def bench_stress(sizes=(1000, 4000, 16000)):
+    """Time per comment for growing pathological inputs, with the tokenizer and the old regex."""
+    regex_scan = _regex_scanner()
+    for name, piece in PATHOLOGICAL.items():
+        for size in sizes:
+            text = piece * max(1, size // len(piece))
+            for label, func in [('find_units', lambda text: list(Unit.find_units(text))),
+                                ('regex', regex_scan)]:
+                timer = timeit.Timer(lambda: func(text))
+                number, total = timer.autorange()
+                print('{:<40} {:>10.2f} ms'.format(
+                    '{} ({}, {} chars)'.format(label, name, len(text)), total / number * 1000))
+
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import unit
+imported = time.perf_counter()
+unit.Unit.has_units('5 miles')
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def bench_startup(runs=20):
+    """Median time to import unit and use it once, in new processes."""
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for name, env in [('no cache', {}), ('matcher cache', {'CONVERTS2USELESS_CACHE': cache_dir})]:
+            env = dict(os.environ, **env)
+            if name == 'no cache':
+                env.pop('CONVERTS2USELESS_CACHE', None)
+            times = []
+            for i in range(runs):
+                output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], env=env,
+                                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+                times.append([float(seconds) * 1000 for seconds in output.split()])
+            import_times, first_use_times = [sorted(column) for column in zip(*times)]
+            print('{:<40} {:>8.1f} ms import {:>8.1f} ms first use'.format(
+                'startup ({})'.format(name), import_times[runs // 2], first_use_times[runs // 2]))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+class _OldUnit(object):
+    """
+    Unit as it was before it had __slots__, only what matters for memory:
+    an instance dict, the span as a tuple, and a new normal unit every time
+    the normal value is needed.
+
+    """
+    def __init__(self, category, value, unit=None, original=None, span=None):
+        self.category = category
+        self.value = value
+        self.unit = unit
+        self.original = original
+        self.span = span
+
+    def to_normal(self):
+        if self.unit is None:
+            return self
+        return _OldUnit(self.category, unit.convert(self.value, self.unit, self.category), original=self)
+
+
+def bench_memory():
+    comments = (COMMENTS_WITH_UNITS + COMMENTS_WITHOUT_UNITS) * 5000
+
+    def old_units():
+        units = [_OldUnit(found.category, found.value, found.unit, span=found.span)
+                 for text in comments for found in Unit.iter_units(text)]
+        # kept, as every use of the normal value needed one
+        return units, [found.to_normal() for found in units]
+
+    def new_units():
+        units = [found for text in comments for found in Unit.iter_units(text)]
+        for found in units:
+            found.normal_value
+        return units, None
+
+    def measure(name, make_units):
+        tracemalloc.start()
+        units, normals = make_units()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('{:<40} {:>12,.0f} bytes/unit'.format(name, size / float(len(units))))
+
+    for backend in (unit.DECIMAL, unit.FLOAT):
+        unit.set_backend(backend)
+        try:
+            measure('units before __slots__ ({})'.format(backend), old_units)
+            measure('units with __slots__ ({})'.format(backend), new_units)
+        finally:
+            unit.set_backend(unit.DECIMAL)
+
+
+def bench_detect():
+    corpus = make_corpus(5000)
+
+    def first_unit(text):
+        return Unit.may_have_units(text) and Unit.find_first_unit(text) is not None
+
+    bench('may_have_units + find_first_unit', first_unit, corpus)
+    bench('has_units', Unit.has_units, corpus)
+
+
+def bench_replies():
+    from fake_reddit import FakeReddit
+
+    reddit = FakeReddit(['comment'] * 100)
+    comments = reddit.get_comments('test')
+    # a round trip to reddit for every reply
+    reddit.latency = 0.01
+
+    for workers in (0, 2, 4, 8):
+        def send(comments):
+            replies = ReplyQueue(workers=workers)
+            replies.start()
+            for comment in comments:
+                replies.put(comment, 'reply')
+            replies.stop()
+
+        bench('replies ({} workers)'.format(workers), send, comments, repeat=1, batch=True)
+
+
+SINGLE_UNITS = [
+    "I walked {} miles to get here.",
+    "it took {} minutes to load",
+    "my car weighs {} pounds",
+    "we drove {} mph on the highway",
+    "that's {} gallons of water",
+    "this engine makes {} horse power",
+]
+
+CHAINS = [
+    "she is {}'{}\" tall",
+    "the movie runs for {} hours and {} minutes",
+    "I waited {} minutes {} seconds for the bus",
+]
+
+BLACKLISTED = [
+    "I wouldn't touch it with a 10ft pole.",
+    "they went the whole 9 yards",
+    "open 24 hours a day, 7 days a week",
+]
+
+# number of filler sentences per comment, from short to very long
+COMMENT_LENGTHS = [1, 1, 2, 3, 5, 10, 50, 200]
+
+
+def make_corpus(size=2000, seed=0):
+    """
+    Generate a reproducible mix of comments without units, with single
+    units, chains and blacklisted units, from one to hundreds of sentences.
+
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        sentences = [rng.choice(COMMENTS_WITHOUT_UNITS) for j in range(rng.choice(COMMENT_LENGTHS))]
+        kind = rng.random()
+        if kind < 0.4:
+            special = rng.choice(SINGLE_UNITS).format(rng.randint(1, 5000))
+        elif kind < 0.55:
+            special = rng.choice(CHAINS).format(rng.randint(1, 12), rng.randint(1, 59))
+        elif kind < 0.65:
+            special = rng.choice(BLACKLISTED)
+        else:
+            special = None
+        if special:
+            sentences.insert(rng.randint(0, len(sentences)), special)
+        corpus.append(' '.join(sentences))
+    return corpus
+
+
+def measure(func, items, repeat=3):
+    """
+    Time `func` on every item. Returns the best throughput of `repeat` runs
+    and the latency percentiles over all calls, in microseconds.
+
+    """
+    timer = time.perf_counter
+    latencies = []
+    best = None
+    for i in range(repeat):
+        run_latencies = []
+        for item in items:
+            start = timer()
+            func(item)
+            run_latencies.append(timer() - start)
+        total = sum(run_latencies)
+        best = total if best is None else min(best, total)
+        latencies.extend(run_latencies)
+
+    latencies.sort()
+    result = {'throughput': len(items) / best}
+    for p in (50, 90, 99):
+        result['p{}'.format(p)] = latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1e6
+    return result
+
+
+def run_suite(corpus):
+    """Run the benchmarks of the suite, returns their results by name."""
+    random.seed(0)
+    units = [found for text in corpus for found in Unit.find_units(text) if not isinstance(found, list)]
+    normals = list(Unit.find_normalized(' '.join(corpus)))
+    values = [normal.value for normal in normals]
+    pairs = [(found, found.to_normal()) for found in units]
+
+    from fake_reddit import FakeComment, FakeReddit
+    from loadtest import make_bot
+
+    reddit = FakeReddit([])
+    path = tempfile.mkdtemp()
+    bot = make_bot(reddit, path, {'reply_workers': 0})
+    bot.bot_start()
+    comments = [FakeComment(reddit, i, 'test', text, 0) for i, text in enumerate(corpus)]
+    comments = [comment for comment in comments if bot.comment_has_units(comment)]
+
+    def reply(comment):
+        bot.comment_has_units(comment)
+        bot.reply_comment(comment)
+
+    suite = OrderedDict([
+        ('find_units', (lambda text: list(Unit.find_units(text)), corpus)),
+        ('find_normalized', (lambda text: list(Unit.find_normalized(text)), corpus)),
+        ('prettify', (unit.prettify, values)),
+        ('__eq__', (lambda pair: pair[0] == pair[1], pairs)),
+        ('to_useless', (lambda normal: normal.to_useless(), normals)),
+        ('reply_comment', (reply, comments)),
+    ])
+    results = OrderedDict()
+    for name, (func, items) in suite.items():
+        results[name] = measure(func, items)
+    bot.bot_stop()
+    shutil.rmtree(path)
+    return results
+
+
+def print_results(results, baseline=None, threshold=0.1):
+    """Print the results next to the baseline, returns the names that got slower."""
+    regressions = []
+    print('{:<20} {:>12} {:>10} {:>10} {:>10} {:>10}'.format(
+        'benchmark', 'per second', 'p50 us', 'p90 us', 'p99 us', 'baseline'))
+    for name, result in results.items():
+        line = '{:<20} {throughput:>12,.0f} {p50:>10.1f} {p90:>10.1f} {p99:>10.1f}'.format(name, **result)
+        if baseline and name in baseline:
+            change = result['throughput'] / baseline[name]['throughput'] - 1
+            line += ' {:>+10.1%}'.format(change)
+            if change < -threshold:
+                regressions.append(name)
+                line += ' SLOWER'
+        print(line)
+    return regressions
+
+
+def bench_suite(args=None):
+    parser = argparse.ArgumentParser(prog='benchmark.py suite')
+    parser.add_argument('--size', type=int, default=2000, help='number of comments')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the corpus')
+    parser.add_argument('--save', help='save the results to a JSON file')
+    parser.add_argument('--compare', help='compare with results saved before')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown that counts as a regression, default 0.1')
+    args = parser.parse_args(args or [])
+
+    results = run_suite(make_corpus(args.size, args.seed))
+
+    baseline = None
+    if args.compare:
+        with io.open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    regressions = print_results(results, baseline, args.threshold)
+
+    if args.save:
+        with io.open(args.save, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(results, indent=2))
+    if regressions:
+        sys.exit('slower than the baseline: {}'.format(', '.join(regressions)))
+
+
+BENCHMARKS = {
+    'backends': bench_backends,
+    'batch': bench_batch,
+    'chains': bench_chains,
+    'detect': bench_detect,
+    'memory': bench_memory,
+    'prefilter': bench_prefilter,
+    'replies': bench_replies,
+    'startup': bench_startup,
+    'stress': bench_stress,
+    'suite': bench_suite,
+}
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['suite']:
+        bench_suite(sys.argv[2:])
+    else:
+        for name in sys.argv[1:] or sorted(BENCHMARKS):
+            BENCHMARKS[name]()
@@ -1,29 +1,76 @@
 # -*- encoding: utf-8 -*-
 from __future__ import unicode_literals
 
+import fcntl
 import logging
+import os
 import re
-from random import choice
+import socket
+from collections import OrderedDict
+from itertools import product
+from random import choice, randrange
 from operator import attrgetter
 
+from praw import Reddit
 from reddit_bot import RedditCommentBot, RedditMessageBot
+import instrument
+import unit
+from replies import ReplyQueue
+from seen import SeenFilter
+from shadow import Shadow, load_engine
+from sharding import FileCoordinator, ForwardedMessage, Shard
 from unit import Unit
 
 
 logger = logging.getLogger(__name__)
 
 
-def _template_choice(match):
-    return choice(match.group(1).split('/'))
+class ReplyTemplate(object):
+    """
+    A reply template with choices, e.g. ``"{value}[!/.]"``.
+
+    The template is parsed once into literal segments with a choice between
+    them, calling it picks a random alternative for each choice and formats
+    the result with the keyword arguments.
+
+    """
+    CHOICE = re.compile(r'\[(.*?)\]')
+
+    def __init__(self, template):
+        parts = self.CHOICE.split(template)
+        self.literals = parts[0::2]
+        self.choices = [tuple(alternatives.split('/')) for alternatives in parts[1::2]]
+
+    def __call__(self, **kw):
+        return self.render([randrange(len(alternatives)) for alternatives in self.choices], **kw)
+
+    def __len__(self):
+        """Number of variants of the template."""
+        count = 1
+        for alternatives in self.choices:
+            count *= len(alternatives)
+        return count
+
+    def render(self, indexes, **kw):
+        """Render the variant with the given alternative for each choice."""
+        parts = [self.literals[0]]
+        for alternatives, index, literal in zip(self.choices, indexes, self.literals[1:]):
+            parts.append(alternatives[index])
+            parts.append(literal)
+        return ''.join(parts).format(**kw)
+
+    def variants(self, **kw):
+        """Yield every variant of the template."""
+        for indexes in product(*(range(len(alternatives)) for alternatives in self.choices)):
+            yield self.render(indexes, **kw)
 
 
 def compile_template(template):
     """Takes a substitution template and returns a function that takes format parameters."""
-    reg = r'\[(.*?)\]'
-    return lambda **kw: re.sub(reg, _template_choice, template).format(**kw)
+    return ReplyTemplate(template)
 
 
-REPLY_TEMPLATES = map(compile_template, [
+REPLY_TEMPLATES = list(map(compile_template, [
     "{original}[/ you say]? [that is/that's] like {value}![ \\*the more you know\\*/]",
     "[In/in] other words, {original} is [exactly/precisely/specifically] {value}[,/.] [nice/neat/neato]!",
     "[BTW/btw,/Oh/oh,/Did you know?] {original} is [the same as/exactly/precisely/specifically] {value}[./!/]",
@@ -31,7 +78,7 @@ REPLY_TEMPLATES = map(compile_template, [
     "I have [calculated/computed/determined] {original} [as/is] [exactly/precisely/specifically] {value}[./!/]",
     "[You/you] [can/could] also say that[ is/'s] {value} [instead of/in place of/rather than] {original}[./!/]",
     "{value} is the same as {original}[, just so you know/][./!/]",
-])
+]))
 
 REPLY_INFO = ' [[BotInfo]](/r/Converts2Useless "Bot Version {}")'
 
@@ -49,21 +96,228 @@ class ConvertBot(RedditCommentBot, RedditMessageBot):
 
     TEST_THREAD = 't3_3ntsw3'  # https://redd.it/3ntsw3
 
+    # how many scanned comments to keep around for reply_comment
+    PARSED_COMMENTS_SIZE = 256
+
+    # returns a new logged in session for a reply worker, set by _login
+    new_session = None
+
+    def _login(self, config):
+        super(ConvertBot, self)._login(config)
+        user_agent = self.USER_AGENT.format(
+            name=self.bot_name,
+            admin=self.admin_name,
+            version='.'.join(map(str, self.VERSION))
+        )
+
+        def new_session():
+            session = Reddit(user_agent)
+            session.set_oauth_app_info(**config['oauth_info'])
+            session.set_access_credentials(**config['access_info'])
+            return session
+        self.new_session = new_session
+
     def bot_start(self):
+        if self.settings.get('instrument'):
+            # before the comment checks are collected, so they are timed too
+            instrument.enable()
         super(ConvertBot, self).bot_start()
+        if self.settings.get('matcher_cache'):
+            unit.MATCHER_CACHE_DIR = self.settings['matcher_cache']
+        for source in self.settings.get('categories', []):
+            unit.load_categories(source)
         self.reply_info = REPLY_INFO.format('.'.join(map(str, self.VERSION)))
+        self.shard = None
+        if self.settings.get('shard_dir'):
+            coordinator = FileCoordinator(
+                self.settings['shard_dir'],
+                self.settings.get('shard_id') or socket.gethostname(),
+                timeout=self.settings.get('shard_timeout', 120),
+            )
+            self.shard = Shard(coordinator, interval=self.settings.get('shard_interval', 30))
+            self.shard.refresh(force=True)
+        self.subreddits = self.owned_subreddits(self.subreddits)
+        self.blocked_users = set(self.blocked_users)
+        self.blocked_users_stat = None
+        self.subreddits_changed = False
+        self.subreddit_changes = {}
+        self.user_changes = {}
+        self.parsed_comments = OrderedDict()
+        self.seen_comments = SeenFilter(
+            self.settings.get('seen_file'),
+            capacity=self.settings.get('seen_capacity', 100000),
+            error_rate=self.settings.get('seen_error_rate', 0.001),
+        )
+        self.shadow = None
+        if self.settings.get('shadow_engine'):
+            self.shadow = Shadow(
+                load_engine(self.settings['shadow_engine']),
+                rate=self.settings.get('shadow_rate', 0.01),
+                path=self.settings.get('shadow_log'),
+            )
+        self.replies = ReplyQueue(
+            workers=self.settings.get('reply_workers', 1),
+            size=self.settings.get('reply_queue_size', 32),
+            session=self.new_session,
+        )
+        self.replies.start()
+        self.blacklist_mtime = None
+        self.reload_blacklist()
+        self.stats_reporter = instrument.Reporter(
+            interval=self.settings.get('stats_interval', 600),
+            path=self.settings.get('stats_file'),
+        )
+
+    def reload_blacklist(self):
+        """Load the blacklist file from the settings if it has changed."""
+        path = self.settings.get('blacklist_file')
+        if not path:
+            return
+        try:
+            mtime = os.path.getmtime(path)
+            if mtime != self.blacklist_mtime:
+                unit.load_blacklist(path)
+                self.blacklist_mtime = mtime
+        except OSError as e:
+            # e.g. while an editor replaces the file, try again next time
+            logger.warning('Keeping the blacklist, cannot read {}: {}'.format(path, e))
+
+    def bot_stop(self):
+        self.replies.stop()
+        self.seen_comments.close()
+        if self.shard is not None:
+            self.shard.leave()
+        if self.shadow is not None:
+            logger.info('Shadow engine:\n' + self.shadow.summary())
+            self.shadow.close()
+        super(ConvertBot, self).bot_stop()
+
+    def owned_subreddits(self, subreddits):
+        """The subreddits this shard loops over, all of them when not sharded."""
+        if self.shard is None:
+            return set(subreddits)
+        return {subreddit for subreddit in subreddits if self.shard.owns('r/' + subreddit.lower())}
+
+    def sync_shard(self):
+        """
+        Handle forwarded messages and check for shards that joined or left.
+
+        Returns True if the subreddits of this shard changed.
+
+        """
+        if self.shard is None:
+            return False
+        self.reload_blocked_users()
+        forwarded = list(self.shard.receive())
+        for data in forwarded:
+            message = ForwardedMessage(data, self.r.send_message)
+            if data['kind'] == 'subreddit':
+                self.on_subreddit_message(data['name'], message)
+            else:
+                self.on_user_message(data['name'], message)
+        if forwarded:
+            self.after_mail_check()
+        changed = self.subreddits_changed
+        self.subreddits_changed = False
+        return self.shard.refresh() or changed
+
+    def reload_blocked_users(self):
+        """
+        Read the blocked users file again if it changed, e.g. because another
+        shard blocked a user. Changes of this shard that aren't saved yet are
+        kept.
+
+        """
+        stat = os.stat(self.blocked_users_file)
+        if (stat.st_mtime_ns, stat.st_size) == self.blocked_users_stat:
+            return
+        self.blocked_users_stat = stat.st_mtime_ns, stat.st_size
+        blocked_users = set(self._get_blocked_users())
+        for name, add in self.user_changes.items():
+            if add:
+                blocked_users.add(name)
+            else:
+                blocked_users.discard(name)
+        self.blocked_users = blocked_users
+
+    def forward_message(self, kind, name, message, reply_to):
+        """Send a start/stop message to the shard owning `name`, returns True if forwarded."""
+        key = ('r/' if kind == 'subreddit' else 'u/') + name.lower()
+        if self.shard is None or self.shard.owns(key):
+            return False
+        logger.info('Forwarding message for {} to shard {}'.format(key, self.shard.owner(key)))
+        self.shard.forward(key, {
+            'key': key,
+            'kind': kind,
+            'name': name,
+            'subject': message.subject,
+            'reply_to': reply_to,
+        })
+        message.mark_as_read()
+        return True
+
+    def loop(self, subreddit):
+        self.reload_blacklist()
+        self.seen_comments.flush()
+        self.stats_reporter.maybe_report()
+        if self.sync_shard() or subreddit not in self.subreddits:
+            return self.BOT_SHOULD_REFRESH
+        super(ConvertBot, self).loop(subreddit)
+        if self.subreddits_changed:
+            # the set can't change while do_loop is iterating it
+            self.subreddits_changed = False
+            return self.BOT_SHOULD_REFRESH
+
+    def refresh(self):
+        self.sync_shard()
+        super(ConvertBot, self).refresh()
+        self.subreddits = self.owned_subreddits(self.subreddits)
 
     def get_comment_checks(self):
         checks = super(ConvertBot, self).get_comment_checks()
-        return checks + [self.comment_has_units]
+        return [self.comment_not_seen] + checks + [self.comment_has_units]
+
+    def comment_not_seen(self, comment):
+        """Check every comment only once, even across restarts."""
+        return not self.seen_comments.add(comment.id)
 
     def comment_has_units(self, comment):
         logger.debug('comment_has_units(comment={!r})'.format(comment.id))
-        return any(Unit.find_units(comment.body))
+        if self.shadow is not None:
+            self.shadow.maybe_compare(comment.body, comment.id)
+        if not Unit.may_have_units(comment.body):
+            return False
+        # the scan stops at the first unit, reply_comment continues it
+        units = Unit.find_units(comment.body)
+        first = next(units, None)
+        if first is None:
+            return False
+        self.parsed_comments[comment.id] = first, units
+        if len(self.parsed_comments) > self.PARSED_COMMENTS_SIZE:
+            self.parsed_comments.popitem(last=False)
+        return True
+
+    def parse_comment(self, comment):
+        """
+        Find the units in a comment.
+
+        The scan `comment_has_units` started is continued if it's among the
+        last `PARSED_COMMENTS_SIZE` comments, so a comment is only scanned
+        once, and comments rejected by later checks aren't scanned to the
+        end at all.
+
+        """
+        if comment.id not in self.parsed_comments:
+            return list(Unit.find_units(comment.body))
+        first, units = self.parsed_comments.pop(comment.id)
+        return [first] + list(units)
 
     def reply_comment(self, comment):
+        units = self.parse_comment(comment)
+        if not units:
+            return False
         unit = max(
-            Unit.find_normalized(comment.body),
+            Unit.normalize(units),
             key=attrgetter('value')
         )
 
@@ -76,50 +330,128 @@ class ConvertBot(RedditCommentBot, RedditMessageBot):
         )
 
         logger.info('reply_comment: {!r}'.format(reply_text))
-        comment.reply(reply_text + self.reply_info)
+        self.replies.put(comment, reply_text + self.reply_info)
         return comment.link_id != self.TEST_THREAD
 
-    def before_mail_check(self):
-        self.add_subreddits_list = []
-        self.remove_subreddits_list = []
-        self.block_users_list = []
-        self.unblock_users_list = []
-
     def on_subreddit_message(self, subreddit, message):
+        if self.forward_message('subreddit', subreddit, message, '/r/' + subreddit):
+            return
+
         if 'start' in message.subject.lower():
-            if not self.is_subreddit_whitelisted(subreddit):
+            if self.startstop(message, '/r/' + subreddit, self.subreddits, self.subreddit_changes,
+                              subreddit, True):
                 logger.info('Start /r/%s' % subreddit)
-                self.add_subreddits_list.append(subreddit)
-                self.reply_startstop(message, '/r/' + subreddit)
+                self.subreddits_changed = True
 
         elif 'stop' in message.subject.lower():
-            if self.is_subreddit_whitelisted(subreddit):
+            if self.startstop(message, '/r/' + subreddit, self.subreddits, self.subreddit_changes,
+                              subreddit, False, stop=True):
                 logger.info('Stop /r/%s' % subreddit)
-                self.remove_subreddits_list.append(subreddit)
-                self.reply_startstop(message, '/r/' + subreddit, stop=True)
+                self.subreddits_changed = True
 
     def on_user_message(self, user, message):
+        if self.forward_message('user', user, message, user):
+            return
+
         if 'start' in message.subject.lower():
-            if self.is_user_blocked(user):
+            if self.startstop(message, '/u/' + user, self.blocked_users, self.user_changes, user, False):
                 logger.info('Removed from blacklist: /u/%s' % user)
-                self.unblock_users_list.append(user)
-                self.reply_startstop(message, '/u/' + user)
 
         elif 'stop' in message.subject.lower():
-            if not self.is_user_blocked(user):
+            if self.startstop(message, '/u/' + user, self.blocked_users, self.user_changes, user, True,
+                              stop=True):
                 logger.info('Added to blacklist /u/%s' % user)
-                self.block_users_list.append(user)
-                self.reply_startstop(message, '/u/' + user, stop=True)
+
+    def startstop(self, message, recipient, names, changes, name, add, stop=False):
+        """
+        Reply to a start/stop message, then change the state. Returns False
+        and only marks the message as read if there is nothing to change.
+
+        If the reply fails, the message stays unread and nothing changed, so
+        it is handled again with the next mail check.
+
+        """
+        if (name in names) == add:
+            message.mark_as_read()
+            return False
+        self.reply_startstop(message, recipient, stop=stop)
+        return self.change_state(names, changes, name, add)
+
+    def add_subreddits(self, *subreddits):
+        self._change_subreddits(subreddits, True)
+
+    def remove_subreddits(self, *subreddits):
+        self._change_subreddits(subreddits, False)
+
+    def _change_subreddits(self, subreddits, add):
+        """
+        Change subreddits outside of mail checks, e.g. when one is forbidden.
+
+        Only the change is saved, the subreddits of a shard are just a part
+        of the file.
+
+        """
+        for subreddit in subreddits:
+            if self.change_state(self.subreddits, self.subreddit_changes, subreddit, add):
+                self.subreddits_changed = True
+        self.save_changes(self.subreddit_changes, self.subreddits_file)
+
+    def change_state(self, names, changes, name, add):
+        """
+        Add a name to or remove it from a set right away, so later messages of
+        the same mail check see it. Returns False if there was nothing to do.
+
+        `changes` keeps the net changes since they were last saved.
+
+        """
+        if (name in names) == add:
+            return False
+        if add:
+            names.add(name)
+        else:
+            names.remove(name)
+
+        if name in changes:
+            # changed back within the same batch
+            del changes[name]
+        else:
+            changes[name] = add
+        return True
 
     def after_mail_check(self):
-        if self.add_subreddits_list:
-            self.add_subreddits(*self.add_subreddits_list)
-        if self.remove_subreddits_list:
-            self.remove_subreddits(*self.remove_subreddits_list)
-        if self.block_users_list:
-            self.block_users(*self.block_users_list)
-        if self.unblock_users_list:
-            self.unblock_users(*self.unblock_users_list)
+        self.save_changes(self.subreddit_changes, self.subreddits_file)
+        self.save_changes(self.user_changes, self.blocked_users_file)
+
+    def save_changes(self, changes, filename):
+        """
+        Append added names to the file, only rewrite it if names were removed.
+
+        The file is locked and read again before it is rewritten, so shards
+        sharing it don't undo each other's changes.
+
+        """
+        if not changes:
+            return
+        with open(filename, 'rb+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if all(changes.values()):
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')
+                f.write('\n'.join(changes).encode('utf-8'))
+            else:
+                names = set(filter(None, map(str.strip, f.read().decode('utf-8').splitlines())))
+                for name, add in changes.items():
+                    if add:
+                        names.add(name)
+                    else:
+                        names.discard(name)
+                f.seek(0)
+                f.truncate()
+                f.write('\n'.join(names).encode('utf-8'))
+        changes.clear()
 
     def reply_startstop(self, message, recipient, stop=False):
         if stop:
@@ -0,0 +1,193 @@
+# -*- encoding: utf-8 -*-
+"""
+A local stand-in for the parts of praw's `Reddit` the bot uses.
+
+    reddit = FakeReddit(texts, subreddits=['test'], rate=100, latency=0.05)
+    bot.r = reddit
+
+Comments become visible `rate` per second, spread over the subreddits, and
+every API call takes `latency` seconds. Replies fail with `RateLimitExceeded`
+with a probability of `rate_limit`. Replies are captured with the time they
+took after the comment was posted.
+
+"""
+from __future__ import unicode_literals
+
+import io
+import json
+import threading
+import time
+from collections import deque
+from itertools import count
+from random import Random
+
+from praw.errors import RateLimitExceeded
+
+
+class FakeAuthor(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeSubreddit(object):
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class FakeComment(object):
+    def __init__(self, reddit, number, subreddit, body, created):
+        self.reddit_session = reddit
+        self.id = 'c{}'.format(number)
+        self.fullname = 't1_' + self.id
+        self.link_id = 't3_{}'.format(subreddit)
+        self.parent_id = self.link_id
+        self.subreddit = FakeSubreddit(subreddit)
+        self.author = FakeAuthor('user{}'.format(number % 100))
+        self.body = body
+        self.created = created
+        self.created_utc = created
+        self.score = 1
+        self.score_hidden = False
+        self.is_root = True
+
+    def reply(self, text):
+        self.reddit_session._reply(self, text)
+
+
+class FakeMessage(object):
+    def __init__(self, reddit, number, subject, author=None, subreddit=None):
+        self.reddit_session = reddit
+        self.id = 'm{}'.format(number)
+        self.fullname = 't4_' + self.id
+        self.subject = subject
+        self.author = FakeAuthor(author) if author else None
+        self.subreddit = FakeSubreddit(subreddit) if subreddit else None
+        self.created = time.time()
+
+    def reply(self, text):
+        self.reddit_session._reply(self, text)
+
+    def mark_as_read(self):
+        if self in self.reddit_session.unread:
+            self.reddit_session.unread.remove(self)
+
+
+class FakeUser(object):
+    def __init__(self, name, has_mail):
+        self.name = name
+        self.has_mail = has_mail
+
+
+class FakeReddit(object):
+    """
+    Serves `texts` as comments, `rate` per second or all at once if None.
+
+    """
+    def __init__(self, texts, subreddits=('test',), rate=None, latency=0.0, rate_limit=0.0,
+                 sleep_time=1, name='Converts2Useless', seed=None):
+        self.subreddits = list(subreddits)
+        self.rate = rate
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.sleep_time = sleep_time
+        self.name = name
+        self.random = Random(seed)
+        self.start = time.time()
+        self.pending = deque(enumerate(texts))
+        self.comments = {subreddit: [] for subreddit in self.subreddits}
+        self.positions = {}
+        self.things = {}
+        self.unread = []
+        self.errors = {}
+        self.replies = []
+        self.sent = []
+        self.fetched = 0
+        self.rate_limited = 0
+        self._message_numbers = count()
+        self._lock = threading.Lock()
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _post_comments(self):
+        """Make the comments visible that were posted by now."""
+        now = time.time()
+        while self.pending:
+            number, body = self.pending[0]
+            created = now if self.rate is None else self.start + number / float(self.rate)
+            if created > now:
+                break
+            self.pending.popleft()
+            subreddit = self.subreddits[number % len(self.subreddits)]
+            comment = FakeComment(self, number, subreddit, body, created)
+            self.positions[comment.fullname] = len(self.comments[subreddit])
+            self.things[comment.fullname] = comment
+            self.comments[subreddit].append(comment)
+
+    @property
+    def done(self):
+        """All comments are posted."""
+        return not self.pending
+
+    def _rate_limit_error(self):
+        return RateLimitExceeded('RATELIMIT', 'you are doing that too much', None,
+                                 {'ratelimit': self.sleep_time})
+
+    def _reply(self, thing, text):
+        self._call()
+        with self._lock:
+            errors = self.errors.get(thing.fullname)
+            if errors:
+                error = errors.pop(0)
+                if isinstance(error, RateLimitExceeded):
+                    self.rate_limited += 1
+                raise error
+            if self.rate_limit and self.random.random() < self.rate_limit:
+                self.rate_limited += 1
+                raise self._rate_limit_error()
+            self.replies.append((thing, text, time.time() - thing.created))
+
+    def fail(self, thing, error=None):
+        """Make the next reply to `thing` fail with `error`, rate limited if None."""
+        self.errors.setdefault(thing.fullname, []).append(error or self._rate_limit_error())
+
+    def post_message(self, subject, author=None, subreddit=None):
+        """Send a message to the bot."""
+        self.unread.append(FakeMessage(self, next(self._message_numbers), subject, author, subreddit))
+
+    def get_comments(self, subreddit, limit=None, params=None):
+        self._call()
+        self._post_comments()
+        before = (params or {}).get('before')
+        start = self.positions[before] + 1 if before in self.positions else 0
+        comments = self.comments[subreddit][start:start + limit if limit else None]
+        self.fetched += len(comments)
+        return comments
+
+    def get_info(self, thing_id=None):
+        self._call()
+        return self.things.get(thing_id)
+
+    def get_me(self):
+        self._call()
+        return FakeUser(self.name, bool(self.unread))
+
+    def get_unread(self, unset_has_mail=False):
+        """The messages not marked as read yet."""
+        self._call()
+        return list(self.unread)
+
+    def send_message(self, recipient, subject, text):
+        self._call()
+        self.sent.append((recipient, subject, text))
+
+
+def load_comments(path, field='body'):
+    """The comment texts of a JSON lines dump."""
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)[field]
+            except (ValueError, KeyError, TypeError):
+                continue
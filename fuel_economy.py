@@ -0,0 +1,33 @@
+# -*- encoding: utf-8 -*-
+"""
+Fuel economy units, registered when this module is imported.
+
+Use it with ``unit.load_categories('fuel_economy')`` or the bot's
+``categories`` setting.
+
+"""
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+import unit
+from unit import r
+
+
+FUEL_ECONOMY = 'fuel economy'
+
+KM_L = 'km/l'
+MPG = 'mpg'
+
+
+unit.register_category(FUEL_ECONOMY, [
+    # normalize to kilometers per liter
+    (KM_L, (r(r' ?(?:km/l|kmpl|kilometers per liter|kilometres per litre)\b'), Decimal('1'))),
+    (MPG, (r(r' ?(?:mpg|miles per gallon)\b'), Decimal('0.425144'))),
+], useless_units=[
+    (['furlongs per hogshead'], Decimal('1185.47')),
+    (['smoots per teaspoon'], Decimal('2.89630')),
+], names={
+    KM_L: ['km/l', ' kilometers per liter'],
+    MPG: ['mpg', ' miles per gallon'],
+})
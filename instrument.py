@@ -0,0 +1,208 @@
+# -*- encoding: utf-8 -*-
+"""
+Optional counters and latency histograms for the bot's hot paths.
+
+    import instrument
+    instrument.enable()
+    ...
+    print(instrument.summary())
+
+`enable` wraps the timed functions in place and `disable` puts the originals
+back, so while disabled there is no overhead at all.
+
+"""
+from __future__ import unicode_literals, division
+
+import io
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+
+logger = logging.getLogger(__name__)
+
+counters = Counter()
+histograms = {}
+
+_lock = threading.Lock()
+_originals = []
+
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram(object):
+    """
+    Latencies in buckets of powers of two microseconds.
+
+    """
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Upper bound of the bucket with the `p`th percentile, in seconds."""
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return (1 << bucket) / 1e6
+        return 0.0
+
+
+def count(name, n=1):
+    with _lock:
+        counters[name] += n
+
+
+def record(name, seconds):
+    with _lock:
+        if name not in histograms:
+            histograms[name] = Histogram()
+        histograms[name].add(seconds)
+
+
+def reset():
+    with _lock:
+        counters.clear()
+        histograms.clear()
+
+
+def is_enabled():
+    return bool(_originals)
+
+
+def _timed(name, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return wrapper
+
+
+def _timed_units(name, func):
+    """Time a unit generator lazily and count what it finds per category and unit."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        iterator = func(*args, **kwargs)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    found = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+
+                for unit in found if isinstance(found, list) else [found]:
+                    count('units.{}.{}'.format(unit.category, unit.unit))
+                if isinstance(found, list):
+                    count('chains.{}'.format(found[0].category))
+                yield found
+        finally:
+            record(name, elapsed)
+    return wrapper
+
+
+def _wrap(owner, attr, wrapper):
+    original = owner.__dict__[attr]
+    func = original.__func__ if isinstance(original, staticmethod) else original
+    wrapped = wrapper('{}.{}'.format(owner.__name__, attr), func)
+    if isinstance(original, staticmethod):
+        wrapped = staticmethod(wrapped)
+    setattr(owner, attr, wrapped)
+    _originals.append((owner, attr, original))
+
+
+def enable():
+    """Start timing the hot paths of the unit parser and the bot."""
+    if is_enabled():
+        return
+    from convert_bot import ConvertBot, ReplyTemplate
+    from replies import ReplyQueue
+    from unit import Unit
+
+    _wrap(ConvertBot, 'comment_has_units', _timed)
+    _wrap(ConvertBot, 'reply_comment', _timed)
+    _wrap(Unit, 'may_have_units', _timed)
+    _wrap(Unit, 'has_units', _timed)
+    _wrap(Unit, 'find_units', _timed_units)
+    _wrap(Unit, 'to_useless', _timed)
+    _wrap(ReplyTemplate, '__call__', _timed)
+    _wrap(ReplyQueue, '_send', _timed)
+
+
+def disable():
+    """Put back the original functions, keeping the stats so far."""
+    while _originals:
+        owner, attr, original = _originals.pop()
+        setattr(owner, attr, original)
+
+
+def snapshot():
+    """The counters and latencies in microseconds as a dict."""
+    with _lock:
+        latency = {}
+        for name, histogram in histograms.items():
+            stats = {'count': histogram.count, 'mean': histogram.mean() * 1e6}
+            for p in PERCENTILES:
+                stats['p{}'.format(p)] = histogram.percentile(p) * 1e6
+            latency[name] = stats
+        return {'counters': dict(counters), 'latency': latency}
+
+
+def summary():
+    stats = snapshot()
+    lines = ['{:<32} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'latency (us)', 'count', 'mean', 'p50', 'p90', 'p99')]
+    for name, latency in sorted(stats['latency'].items()):
+        lines.append('{:<32} {count:>8} {mean:>10.1f} {p50:>10.0f} {p90:>10.0f} {p99:>10.0f}'.format(
+            name, **latency))
+    for name, value in sorted(stats['counters'].items()):
+        lines.append('{:<32} {:>8}'.format(name, value))
+    return '\n'.join(lines)
+
+
+def report(path=None):
+    """Log the summary, or append it as a JSON line to the file at `path`."""
+    if path is None:
+        logger.info('Stats:\n' + summary())
+        return
+    stats = snapshot()
+    stats['time'] = time.time()
+    with io.open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(stats) + '\n')
+
+
+class Reporter(object):
+    """
+    Report the stats every `interval` seconds when `maybe_report` is called.
+
+    """
+    def __init__(self, interval=600, path=None):
+        self.interval = interval
+        self.path = path
+        self.last_report = time.time()
+
+    def maybe_report(self):
+        if not is_enabled() or time.time() - self.last_report < self.interval:
+            return
+        report(self.path)
+        self.last_report = time.time()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Run ConvertBot end to end against a local fake of Reddit.
+
+    python loadtest.py --size 2000 --rate 200 --latency 0.02 --rate-limit 0.01
+    python loadtest.py comments.json --subreddits 8 --messages 50
+
+Comments are replayed from a JSON lines dump or generated like the benchmark
+corpus. The report has the comments processed per second, reply latencies
+from posting a comment or message to the reply, and the depths of the reply
+queue and of the unread mail.
+
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from praw.errors import RateLimitExceeded
+from reddit_bot import DEFAULT_SETTINGS
+
+from convert_bot import ConvertBot
+from fake_reddit import FakeComment, FakeReddit, load_comments
+
+
+def make_bot(reddit, path, settings=None, blocked_users=()):
+    """
+    A ConvertBot using `reddit`, with its files in the directory `path`.
+
+    Unless they exist already, so several bots can share them, the subreddits
+    file gets the subreddits of `reddit` and the blocked users file gets
+    `blocked_users`. The bot isn't started yet.
+
+    """
+    bot = ConvertBot.__new__(ConvertBot)
+    bot.bot_name = reddit.name
+    bot.admin_name = 'admin'
+    bot.r = reddit
+    bot.settings = dict(DEFAULT_SETTINGS)
+    bot.settings.update({
+        'check_parent_comments': False,
+        'comment_max_age': 3600,
+        'max_replies_per_post': 10 ** 9,
+        'subreddit_timeout': 0,
+        'check_mail': 1,
+    })
+    bot.settings.update(settings or {})
+    bot.subreddits_file = os.path.join(path, 'subreddits.txt')
+    bot.blocked_users_file = os.path.join(path, 'blocked_users.txt')
+    if not os.path.exists(bot.subreddits_file):
+        bot._set_file_lines(bot.subreddits_file, reddit.subreddits)
+    if not os.path.exists(bot.blocked_users_file):
+        bot._set_file_lines(bot.blocked_users_file, blocked_users)
+    bot.subreddits = bot._get_subreddits()
+    bot.blocked_users = bot._get_blocked_users()
+    return bot
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {'p50': 0.0, 'p90': 0.0, 'p99': 0.0}
+    return {'p{}'.format(p): values[min(len(values) - 1, len(values) * p // 100)]
+            for p in (50, 90, 99)}
+
+
+def _caught_up(bot, reddit):
+    if not reddit.done:
+        return False
+    for subreddit, comments in reddit.comments.items():
+        if comments and bot.subreddit_fullnames.get(subreddit) != comments[-1].fullname:
+            return False
+    return True
+
+
+def run(bot, reddit, messages=0, duration=None):
+    """
+    Loop the bot over its subreddits like `do_loop`, without sleeping, until
+    it has seen every comment or `duration` seconds passed.
+
+    `messages` start/stop messages from users are sent to the bot, spread
+    over the comments.
+
+    """
+    bot.bot_start()
+    total = len(reddit.pending)
+    every = total // messages if messages else None
+    sent = 0
+    queue_depths = []
+    mail_depths = []
+    mail_times = []
+
+    check_mail = bot.check_mail
+
+    def timed_check_mail():
+        start = time.time()
+        check_mail()
+        if mail_depths and mail_depths[-1]:
+            mail_times.append(time.time() - start)
+    bot.check_mail = timed_check_mail
+
+    loop_rate_limited = [0]
+
+    def rate_limited(func, *args):
+        """Call a step of the bot, sleeping when it is rate limited like `do_loop`."""
+        try:
+            return func(*args)
+        except RateLimitExceeded as e:
+            loop_rate_limited[0] += 1
+            time.sleep(e.sleep_time)
+
+    start = time.time()
+    try:
+        while not _caught_up(bot, reddit):
+            if duration is not None and time.time() - start > duration:
+                break
+            for subreddit in list(bot.subreddits):
+                while every and sent < messages and total - len(reddit.pending) >= sent * every:
+                    reddit.post_message('start' if sent % 2 else 'stop', author='user{}'.format(sent // 2))
+                    sent += 1
+                mail_depths.append(len(reddit.unread))
+                if rate_limited(bot.loop, subreddit) == bot.BOT_SHOULD_REFRESH:
+                    bot.refresh()
+                queue_depths.append(bot.replies.queue.qsize())
+        while reddit.unread:
+            if duration is not None and time.time() - start > duration:
+                break
+            mail_depths.append(len(reddit.unread))
+            rate_limited(bot.check_mail)
+        bot.replies.join()
+    finally:
+        bot.bot_stop()
+    elapsed = time.time() - start
+
+    comment_latencies = [latency for thing, text, latency in reddit.replies if isinstance(thing, FakeComment)]
+    message_latencies = [latency for thing, text, latency in reddit.replies if not isinstance(thing, FakeComment)]
+    return {
+        'elapsed': elapsed,
+        'comments': total - len(reddit.pending),
+        'fetched': reddit.fetched,
+        'comments_per_second': (total - len(reddit.pending)) / elapsed,
+        'replies': len(comment_latencies),
+        'reply_latency': _percentiles(comment_latencies),
+        'messages': len(message_latencies),
+        'message_latency': _percentiles(message_latencies),
+        'mail_check': _percentiles(mail_times),
+        'rate_limited': reddit.rate_limited,
+        'loop_rate_limited': loop_rate_limited[0],
+        'reply_queue': {'mean': sum(queue_depths) / (len(queue_depths) or 1), 'max': max(queue_depths or [0])},
+        'unread_mail': {'max': max(mail_depths or [0])},
+    }
+
+
+def format_report(report):
+    lines = [
+        '{comments} comments in {elapsed:.2f} s, {comments_per_second:,.0f} comments/s, '
+        '{fetched} fetched'.format(**report),
+        '{replies} replies, {messages} message replies, {rate_limited} rate limited, '
+        '{loop_rate_limited} in the loop'.format(**report),
+    ]
+    for name in ('reply_latency', 'message_latency', 'mail_check'):
+        lines.append('{:<16} p50 {p50:>8.1f} ms  p90 {p90:>8.1f} ms  p99 {p99:>8.1f} ms'.format(
+            name.replace('_', ' '), **{key: value * 1000 for key, value in report[name].items()}))
+    lines.append('reply queue      mean {mean:.1f}, max {max}'.format(**report['reply_queue']))
+    lines.append('unread mail      max {max}'.format(**report['unread_mail']))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run ConvertBot against a fake Reddit.')
+    parser.add_argument('input', nargs='?', help='JSON lines comment dump, generated if missing')
+    parser.add_argument('--size', type=int, default=2000, help='number of generated comments')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--subreddits', type=int, default=4, help='number of subreddits')
+    parser.add_argument('--rate', type=float, default=None, help='comments posted per second')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per API call')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='fraction of rate limited replies')
+    parser.add_argument('--sleep-time', type=float, default=0.1, help='seconds to wait when rate limited')
+    parser.add_argument('--messages', type=int, default=0, help='number of start/stop messages')
+    parser.add_argument('--workers', type=int, default=1, help='reply worker threads')
+    parser.add_argument('--duration', type=float, default=None, help='stop after this many seconds')
+    args = parser.parse_args(args)
+
+    if args.input:
+        texts = list(load_comments(args.input))
+    else:
+        from benchmark import make_corpus
+        texts = make_corpus(args.size, args.seed)
+
+    reddit = FakeReddit(
+        texts, ['loadtest{}'.format(i) for i in range(args.subreddits)], rate=args.rate,
+        latency=args.latency, rate_limit=args.rate_limit, sleep_time=args.sleep_time, seed=args.seed,
+    )
+    path = tempfile.mkdtemp()
+    try:
+        bot = make_bot(reddit, path, {'reply_workers': args.workers})
+        report = run(bot, reddit, args.messages, args.duration)
+    finally:
+        shutil.rmtree(path)
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+
+import copy
+import logging
+import threading
+import time
+from collections import Counter
+from queue import Queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyQueue(object):
+    """
+    Send replies from a pool of worker threads.
+
+    `put` blocks while the queue is full, which slows down whoever produces
+    the replies instead of piling them up. When a reply fails with an error
+    that has a `sleep_time`, like praw's `RateLimitExceeded`, all workers
+    pause for that long and the reply is tried again.
+
+    Without workers, replies are sent right away by `put`.
+
+    praw isn't thread safe when several threads use the same `Reddit`
+    instance, so `session` is called by every worker for a session of its
+    own, which the replies are sent with. Without it the workers use the
+    session of the comment, which is only safe if that session is.
+
+    """
+    def __init__(self, workers=1, size=32, max_attempts=3, session=None):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.session = session
+        self.queue = Queue(size)
+        self.threads = []
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._paused_until = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='reply-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Send all queued replies, then stop the workers."""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def join(self):
+        """Wait until all queued replies are sent."""
+        self.queue.join()
+
+    def put(self, thing, text):
+        """Queue a reply to a comment or message."""
+        if not self.threads:
+            self._send(thing, text)
+        else:
+            self.queue.put((thing, text))
+
+    def _work(self):
+        session = self.session() if self.session is not None else None
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                thing, text = job
+                if session is not None:
+                    thing = copy.copy(thing)
+                    thing.reddit_session = session
+                self._send(thing, text)
+            finally:
+                self.queue.task_done()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+
+    def _send(self, thing, text):
+        for attempt in range(self.max_attempts):
+            delay = self._paused_until - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                thing.reply(text)
+            except Exception as e:
+                sleep_time = getattr(e, 'sleep_time', None)
+                if sleep_time is None:
+                    logger.exception('reply to {} failed'.format(thing.id))
+                    break
+                logger.warn('Rate limited! Pausing replies for {} seconds.'.format(sleep_time))
+                self._count('rate_limited')
+                self._pause(sleep_time)
+            else:
+                self._count('sent')
+                return
+        self._count('failed')
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Scan a newline-delimited JSON dump of comments for units.
+
+    python scan.py comments.json -o matches.json --workers 4 --category fuel_economy
+
+Every comment with units is written out as a JSON line with its id, line
+number and the units found, in the order of the input. A summary with the
+hit rate per category is printed to stderr when done.
+
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import io
+import json
+import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import unit
+from unit import Unit
+
+
+def _unit_to_json(found):
+    if isinstance(found, list):
+        return [_unit_to_json(chain_unit) for chain_unit in found]
+    return {
+        'category': found.category,
+        'unit': found.unit,
+        'value': str(found.value),
+        'span': list(found.span),
+    }
+
+
+def scan_chunk(lines, start=0, field='body'):
+    """
+    Find the units in a chunk of JSON lines.
+
+    Returns the output lines for comments with units and a Counter of
+    comments, hits and units per category.
+
+    """
+    output = []
+    stats = Counter()
+    for number, line in enumerate(lines, start):
+        try:
+            comment = json.loads(line)
+            text = comment[field]
+        except (ValueError, KeyError, TypeError):
+            stats['invalid'] += 1
+            continue
+
+        stats['comments'] += 1
+        if not Unit.may_have_units(text):
+            continue
+        units = list(Unit.find_units(text))
+        if not units:
+            continue
+
+        stats['hits'] += 1
+        for found in units:
+            category = found[0].category if isinstance(found, list) else found.category
+            stats['units.' + category] += 1
+        output.append(json.dumps({
+            'id': comment.get('id'),
+            'line': number,
+            'units': [_unit_to_json(found) for found in units],
+        }))
+    return output, stats
+
+
+def _chunks(lines, size):
+    lines = iter(lines)
+    start = 0
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+def _load_categories(categories):
+    for source in categories:
+        unit.load_categories(source)
+
+
+def scan(lines, output, workers=1, chunk_size=1000, field='body', categories=()):
+    """
+    Scan JSON lines for units and write the matches to `output` in order.
+
+    Chunks are spread over a pool of `workers` processes. At most two chunks
+    per worker are in flight, so memory stays bounded for any input size.
+    `categories` are loaded with `unit.load_categories` in every process.
+
+    """
+    _load_categories(categories)
+    stats = Counter()
+
+    def write(result):
+        matches, chunk_stats = result
+        for match in matches:
+            output.write(match + '\n')
+        stats.update(chunk_stats)
+
+    if workers <= 1:
+        for start, chunk in _chunks(lines, chunk_size):
+            write(scan_chunk(chunk, start, field))
+        return stats
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_load_categories,
+                             initargs=(categories,)) as pool:
+        for start, chunk in _chunks(lines, chunk_size):
+            if len(pending) >= workers * 2:
+                write(pending.popleft().result())
+            pending.append(pool.submit(scan_chunk, chunk, start, field))
+        while pending:
+            write(pending.popleft().result())
+    return stats
+
+
+def format_stats(stats):
+    comments = stats['comments']
+    lines = ['{} comments, {} with units ({:.2%}), {} invalid lines'.format(
+        comments, stats['hits'], stats['hits'] / float(comments or 1), stats['invalid'])]
+    for key, count in sorted(stats.items()):
+        if key.startswith('units.'):
+            lines.append('  {:<10} {}'.format(key[len('units.'):], count))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Scan a JSON lines comment dump for units.')
+    parser.add_argument('input', help='JSON lines file, - for stdin')
+    parser.add_argument('-o', '--output', default='-', help='output file, - for stdout')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='comments per chunk')
+    parser.add_argument('--field', default='body', help='JSON field with the comment text')
+    parser.add_argument('--category', action='append', default=[], dest='categories',
+                        help='module or JSON file with more unit categories')
+    args = parser.parse_args(args)
+
+    if args.input == '-':
+        lines = sys.stdin
+    else:
+        lines = io.open(args.input, encoding='utf-8')
+    if args.output == '-':
+        output = sys.stdout
+    else:
+        output = io.open(args.output, 'w', encoding='utf-8')
+
+    try:
+        stats = scan(lines, output, args.workers, args.chunk_size, args.field, args.categories)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        if output is not sys.stdout:
+            output.close()
+
+    print(format_stats(stats), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# -*- encoding: utf-8 -*-
+"""
+A bounded set of seen ids that survives restarts.
+
+    seen = SeenFilter('seen.bin', capacity=100000, error_rate=0.001)
+    if not seen.add(comment.id):
+        ...  # first time we see this comment
+
+The ids are kept in two Bloom filters in a memory-mapped file. New ids go into
+the current filter, and once it holds `capacity` ids the older filter is
+cleared and becomes the current one. So at least the last `capacity` ids are
+remembered, the file never grows, and an id that was never added is reported
+as seen with a probability of at most `error_rate`.
+
+"""
+from __future__ import unicode_literals, division
+
+import hashlib
+import io
+import logging
+import math
+import mmap
+import os
+import struct
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'C2US'
+VERSION = 1
+
+# magic, version, bits per filter, hashes, current filter, ids in both filters
+HEADER = struct.Struct('<4sIQIIQQ')
+HEADER_SIZE = 64
+
+
+def filter_size(capacity, error_rate):
+    """Bits and number of hashes for a Bloom filter with `capacity` ids."""
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    bits = (bits + 7) // 8 * 8
+    hashes = max(1, int(round(bits / capacity * math.log(2))))
+    return bits, hashes
+
+
+class SeenFilter(object):
+    """
+    Two rotating Bloom filters in a memory-mapped file, or in anonymous
+    memory if `path` is None.
+
+    """
+    def __init__(self, path=None, capacity=100000, error_rate=0.001):
+        self.path = path
+        self.capacity = capacity
+        # an id is looked up in both filters, so each gets half the error rate
+        self.bits, self.hashes = filter_size(capacity, error_rate / 2)
+        self.size = HEADER_SIZE + 2 * self.bits // 8
+        self._open()
+
+    def _open(self):
+        if self.path is None:
+            self.file = None
+            self.map = mmap.mmap(-1, self.size)
+            self._reset()
+            return
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = io.open(fd, 'r+b')
+        fresh = os.fstat(fd).st_size != self.size
+        if fresh:
+            self.file.truncate(0)
+            self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+        magic, version, bits, hashes = HEADER.unpack_from(self.map)[:4]
+        if not fresh and (magic, version, bits, hashes) != (MAGIC, VERSION, self.bits, self.hashes):
+            logger.warning('Seen file {} does not match the settings, starting over.'.format(self.path))
+            fresh = True
+        if fresh:
+            self._reset()
+
+    def _reset(self):
+        self.map[:] = b'\0' * self.size
+        self._write_header(0, 0, 0)
+
+    def _write_header(self, current, *counts):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.bits, self.hashes, current, *counts)
+
+    def _header(self):
+        current, count0, count1 = HEADER.unpack_from(self.map)[4:]
+        return current, [count0, count1]
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        h2 |= 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _contains(self, positions, index):
+        offset = HEADER_SIZE + index * self.bits // 8
+        bitmap = self.map
+        for position in positions:
+            if not bitmap[offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        return self._contains(positions, 0) or self._contains(positions, 1)
+
+    def __len__(self):
+        """Number of ids added to the filters, including rotated out ones not yet cleared."""
+        return sum(self._header()[1])
+
+    def add(self, key):
+        """Add an id, return True if it was already seen."""
+        positions = self._positions(key)
+        if self._contains(positions, 0) or self._contains(positions, 1):
+            return True
+
+        current, counts = self._header()
+        if counts[current] >= self.capacity:
+            current = 1 - current
+            offset = HEADER_SIZE + current * self.bits // 8
+            self.map[offset:offset + self.bits // 8] = b'\0' * (self.bits // 8)
+            counts[current] = 0
+
+        offset = HEADER_SIZE + current * self.bits // 8
+        bitmap = self.map
+        for position in positions:
+            bitmap[offset + (position >> 3)] |= 1 << (position & 7)
+        counts[current] += 1
+        self._write_header(current, *counts)
+        return False
+
+    def flush(self):
+        if self.file is not None:
+            self.map.flush()
+
+    def close(self):
+        self.flush()
+        self.map.close()
+        if self.file is not None:
+            self.file.close()
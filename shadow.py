@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Run another unit parser next to `Unit.find_units` and log where they differ.
+
+    python shadow.py comments.json --engine mymodule:find_units --rate 0.1 -o shadow.log
+
+Engines are functions like `Unit.find_units`, taking a text and yielding units
+and lists of units for chains, given as "module:function". A sample of the
+comments is parsed by both, every sampled comment is written to the log as a
+JSON line with both latencies, and with the text and both results if they
+differ. The bot does the same for live comments with the shadow_engine,
+shadow_rate and shadow_log settings.
+
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import importlib
+import io
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from random import Random
+
+from instrument import Histogram
+from unit import Unit
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_engine(name):
+    """Import a "module:function" engine, attributes are followed after the module."""
+    module, _, path = name.partition(':')
+    engine = importlib.import_module(module)
+    for attr in path.split('.'):
+        engine = getattr(engine, attr)
+    return engine
+
+
+def _unit_key(found):
+    if isinstance(found, list):
+        return [_unit_key(chain_unit) for chain_unit in found]
+    return [found.category, found.unit, str(found.value), list(found.span)]
+
+
+def _run(engine, text):
+    start = time.perf_counter()
+    try:
+        result = [_unit_key(found) for found in engine(text)]
+    except Exception as e:
+        result = {'error': repr(e)}
+    return result, time.perf_counter() - start
+
+
+class Shadow(object):
+    """
+    Compare `engine` to `reference` for a `rate` fraction of the texts.
+
+    """
+    def __init__(self, engine, rate=0.01, path=None, reference=None, seed=None):
+        self.engine = engine
+        self.rate = rate
+        self.path = path
+        self.reference = reference or Unit.find_units
+        self.random = Random(seed)
+        self.stats = Counter()
+        self.latency = {'reference': Histogram(), 'shadow': Histogram()}
+        self.log = io.open(path, 'a', encoding='utf-8') if path else None
+
+    def maybe_compare(self, text, id=None):
+        """Compare the engines on a sample of the texts, returns False if they differ."""
+        if self.random.random() >= self.rate:
+            return True
+        return self.compare(text, id)
+
+    def compare(self, text, id=None):
+        expected, reference_time = _run(self.reference, text)
+        result, shadow_time = _run(self.engine, text)
+        self.latency['reference'].add(reference_time)
+        self.latency['shadow'].add(shadow_time)
+        self.stats['compared'] += 1
+
+        same = result == expected
+        entry = {'id': id, 'ref_us': int(reference_time * 1e6), 'shadow_us': int(shadow_time * 1e6)}
+        if not same:
+            self.stats['diverged'] += 1
+            if isinstance(result, dict):
+                self.stats['errors'] += 1
+            entry.update(text=text, ref=expected, shadow=result)
+            logger.debug('shadow engine differs on {!r}'.format(id))
+        if self.log is not None:
+            self.log.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        return same
+
+    def summary(self):
+        lines = ['{} compared, {} diverged, {} errors'.format(
+            self.stats['compared'], self.stats['diverged'], self.stats['errors'])]
+        for name in ('reference', 'shadow'):
+            histogram = self.latency[name]
+            lines.append('{:<10} mean {:>8.1f} us  p50 {:>8.0f} us  p99 {:>8.0f} us'.format(
+                name, histogram.mean() * 1e6, histogram.percentile(50) * 1e6,
+                histogram.percentile(99) * 1e6))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+def replay(lines, shadow, field='body'):
+    """Compare the engines on the comments of a JSON lines dump."""
+    for number, line in enumerate(lines):
+        try:
+            comment = json.loads(line)
+            text = comment[field]
+        except (ValueError, KeyError, TypeError):
+            continue
+        shadow.maybe_compare(text, comment.get('id', number))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Compare a unit parser to Unit.find_units.')
+    parser.add_argument('input', help='JSON lines file, - for stdin')
+    parser.add_argument('--engine', required=True, help='module:function to compare')
+    parser.add_argument('--reference', default=None, help='module:function to compare to')
+    parser.add_argument('--rate', type=float, default=1.0, help='fraction of comments to compare')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--field', default='body', help='JSON field with the comment text')
+    parser.add_argument('-o', '--output', default=None, help='log file')
+    args = parser.parse_args(args)
+
+    reference = load_engine(args.reference) if args.reference else None
+    shadow = Shadow(load_engine(args.engine), args.rate, args.output, reference, args.seed)
+    lines = sys.stdin if args.input == '-' else io.open(args.input, encoding='utf-8')
+    try:
+        replay(lines, shadow, args.field)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        shadow.close()
+    print(shadow.summary(), file=sys.stderr)
+    return 1 if shadow.stats['diverged'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+# -*- encoding: utf-8 -*-
+"""
+Split the work of the bot between several processes, possibly on other hosts.
+
+Every shard owns a part of the subreddits by consistent hashing of their
+names, so when shards join or leave only the subreddits of that shard move.
+The shards find each other through a `FileCoordinator`, a directory shared by
+all of them, which also delivers messages forwarded to the owner of a name.
+
+"""
+from __future__ import unicode_literals
+
+import bisect
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys to shards, with `replicas` points per shard.
+
+    """
+    def __init__(self, shards, replicas=64):
+        self.shards = frozenset(shards)
+        points = sorted(
+            (_hash('{}#{}'.format(shard, i)), shard)
+            for shard in self.shards for i in range(replicas)
+        )
+        self._hashes = [point for point, shard in points]
+        self._shards = [shard for point, shard in points]
+
+    def owner(self, key):
+        if not self._shards:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+
+class FileCoordinator(object):
+    """
+    Membership and message delivery through a shared directory.
+
+    Every shard touches a file in `shards/` as its heartbeat, shards without
+    one for `timeout` seconds are gone. Messages for a shard are JSON files in
+    its directory in `inbox/`.
+
+    """
+    def __init__(self, path, shard_id, timeout=120):
+        self.path = path
+        self.shard_id = shard_id
+        self.timeout = timeout
+        self.shards_path = os.path.join(path, 'shards')
+        self.inbox_path = self._inbox(shard_id)
+        for path in (self.shards_path, self.inbox_path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _inbox(self, shard_id):
+        return os.path.join(self.path, 'inbox', shard_id)
+
+    def heartbeat(self):
+        with io.open(os.path.join(self.shards_path, self.shard_id), 'w'):
+            pass
+
+    def leave(self):
+        try:
+            os.remove(os.path.join(self.shards_path, self.shard_id))
+        except OSError:
+            pass
+
+    def members(self):
+        """The ids of all live shards, always including this one."""
+        members = {self.shard_id}
+        expired = time.time() - self.timeout
+        for name in os.listdir(self.shards_path):
+            try:
+                if os.path.getmtime(os.path.join(self.shards_path, name)) > expired:
+                    members.add(name)
+            except OSError:
+                pass
+        return members
+
+    def send(self, shard_id, data):
+        inbox = self._inbox(shard_id)
+        if not os.path.isdir(inbox):
+            os.makedirs(inbox)
+        name = '{:.6f}-{}.json'.format(time.time(), uuid.uuid4().hex)
+        temp = os.path.join(inbox, '.' + name)
+        with io.open(temp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(data))
+        os.replace(temp, os.path.join(inbox, name))
+
+    def receive(self):
+        """Yield and remove the messages for this shard, oldest first."""
+        for name in sorted(os.listdir(self.inbox_path)):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.inbox_path, name)
+            with io.open(path, encoding='utf-8') as f:
+                data = json.loads(f.read())
+            os.remove(path)
+            yield data
+
+
+class Shard(object):
+    """
+    This process' view of the shards, updated every `interval` seconds.
+
+    """
+    def __init__(self, coordinator, interval=30, replicas=64):
+        self.coordinator = coordinator
+        self.interval = interval
+        self.replicas = replicas
+        self.last_refresh = None
+        self.ring = HashRing([coordinator.shard_id], replicas)
+
+    @property
+    def shard_id(self):
+        return self.coordinator.shard_id
+
+    def refresh(self, force=False):
+        """Send a heartbeat and update the ring, returns True if shards joined or left."""
+        now = time.time()
+        if not force and self.last_refresh is not None and now - self.last_refresh < self.interval:
+            return False
+        self.last_refresh = now
+        self.coordinator.heartbeat()
+        members = self.coordinator.members()
+        if members == self.ring.shards:
+            return False
+        logger.info('Shards: {}'.format(', '.join(sorted(members))))
+        self.ring = HashRing(members, self.replicas)
+        return True
+
+    def owner(self, key):
+        return self.ring.owner(key)
+
+    def owns(self, key):
+        return self.ring.owner(key) == self.shard_id
+
+    def forward(self, key, data):
+        """Send `data` to the owner of `key`."""
+        self.coordinator.send(self.owner(key), data)
+
+    def receive(self):
+        return self.coordinator.receive()
+
+    def leave(self):
+        """Leave the ring and hand the undelivered messages to the other shards."""
+        self.coordinator.leave()
+        self.ring = HashRing(self.ring.shards - {self.shard_id}, self.replicas)
+        if not self.ring.shards:
+            return
+        for data in self.receive():
+            self.forward(data['key'], data)
+
+
+class ForwardedMessage(object):
+    """
+    A start/stop message received by another shard.
+
+    The original was marked as read by that shard, replies are sent as new
+    messages with `send(recipient, subject, text)`.
+
+    """
+    def __init__(self, data, send):
+        self.subject = data['subject']
+        self.reply_to = data['reply_to']
+        self.send = send
+
+    def reply(self, text):
+        self.send(self.reply_to, 're: ' + self.subject, text)
+
+    def mark_as_read(self):
+        pass
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+"""
+Tests for the bot's reply templates and mail handling.
+
+"""
+import os
+import time
+
+import pytest
+from praw.errors import RateLimitExceeded
+
+import unit
+from convert_bot import REPLY_TEMPLATES, compile_template
+from fake_reddit import FakeComment, FakeReddit
+from loadtest import make_bot
+from unit import Unit
+
+
+def test_template_variants():
+    template = compile_template("{original}[/ you say]? [that is/that's/it is] {value}!")
+    assert len(template) == 6
+    variants = list(template.variants(original='5 miles', value='1 smoot'))
+    assert len(set(variants)) == 6
+    assert "5 miles you say? that's 1 smoot!" in variants
+    assert "5 miles? it is 1 smoot!" in variants
+
+
+def test_template_without_choices():
+    template = compile_template("{value} is {original}")
+    assert len(template) == 1
+    assert template(original='a', value='b') == "b is a"
+
+
+@pytest.mark.parametrize('template', REPLY_TEMPLATES)
+def test_reply_templates(template):
+    """Random replies are always one of the variants."""
+    variants = set(template.variants(original='5 miles', value='1 smoot'))
+    assert len(variants) == len(template)
+    for i in range(20):
+        assert template(original='5 miles', value='1 smoot') in variants
+
+
+class FakeMessage(object):
+    def __init__(self, subject):
+        self.subject = subject
+        self.replies = []
+
+    def reply(self, text):
+        self.replies.append(text)
+
+    def mark_as_read(self):
+        pass
+
+
+@pytest.fixture
+def bot(tmpdir):
+    reddit = FakeReddit([], subreddits=['test', 'foo'])
+    bot = make_bot(reddit, str(tmpdir), {'reply_workers': 0}, blocked_users=['troll'])
+    bot.bot_start()
+    yield bot
+    bot.bot_stop()
+
+
+def test_mail_batch(bot):
+    """Messages see the changes of earlier messages in the same batch."""
+    bot.before_mail_check()
+    first, again = FakeMessage('stop'), FakeMessage('please stop')
+    bot.on_user_message('alice', first)
+    bot.on_user_message('alice', again)
+    bot.on_subreddit_message('bar', FakeMessage('start'))
+    assert first.replies and not again.replies
+    assert bot.is_user_blocked('alice')
+    bot.after_mail_check()
+
+    assert bot._get_blocked_users() == {'troll', 'alice'}
+    assert bot._get_subreddits() == {'test', 'foo', 'bar'}
+
+
+def test_failed_startstop_reply(bot):
+    """A stop message whose reply failed is answered with the next mail check."""
+    bot.r.post_message('stop', author='alice')
+    message, = bot.r.unread
+    bot.r.fail(message)
+    with pytest.raises(RateLimitExceeded):
+        bot.check_mail()
+    assert not bot.is_user_blocked('alice')
+
+    bot.check_mail()
+    assert bot.is_user_blocked('alice')
+    assert [thing for thing, text, latency in bot.r.replies] == [message]
+    assert not bot.r.unread
+
+    # nothing to change, only marked as read
+    bot.r.post_message('stop', author='alice')
+    bot.check_mail()
+    assert not bot.r.unread
+    assert len(bot.r.replies) == 1
+
+
+def test_mail_batch_changed_back(bot):
+    bot.before_mail_check()
+    bot.on_user_message('troll', FakeMessage('start'))
+    bot.on_user_message('troll', FakeMessage('stop'))
+    bot.on_subreddit_message('foo', FakeMessage('stop'))
+    assert bot.user_changes == {}
+    bot.after_mail_check()
+
+    assert bot._get_blocked_users() == {'troll'}
+    assert bot._get_subreddits() == {'test'}
+
+
+def test_comment_checked_once(bot):
+    comment = FakeComment(bot.r, 0, 'test', '5 miles', time.time())
+    assert bot.comment_not_seen(comment)
+    assert not bot.comment_not_seen(comment)
+    assert bot.comment_checks[0] == bot.comment_not_seen
+
+
+def test_seen_flushed(bot, monkeypatch):
+    """Seen comments are written to disk in every loop, not only with mail."""
+    flushed = []
+    monkeypatch.setattr(bot.seen_comments, 'flush', lambda: flushed.append(True))
+    bot.loop('test')
+    assert flushed
+
+
+def test_reload_blacklist(tmpdir, monkeypatch):
+    """A changed blacklist file is loaded in the next loop, without any mail."""
+    unit._compile_matcher()
+    monkeypatch.setattr(unit, 'BLACKLIST_INDEX', unit.BLACKLIST_INDEX)
+    monkeypatch.setattr(unit, '_BLACKLIST_FILE_ENTRIES', unit._BLACKLIST_FILE_ENTRIES)
+    path = tmpdir.join('blacklist.txt')
+    path.write('')
+    bot = make_bot(FakeReddit([]), str(tmpdir), {'reply_workers': 0, 'blacklist_file': str(path)})
+    bot.bot_start()
+    assert Unit.has_units("I would walk 500 miles")
+
+    path.write('500 miles\n')
+    os.utime(str(path), (time.time() + 10, time.time() + 10))
+    bot.loop('test')
+    assert not Unit.has_units("I would walk 500 miles")
+
+    path.remove()
+    bot.loop('test')
+    bot.bot_stop()
+    assert not Unit.has_units("I would walk 500 miles")
+
+
+def test_parsed_once(bot, monkeypatch):
+    """The reply continues the scan of the check, comments are only scanned once."""
+    comment = FakeComment(bot.r, 0, 'test', 'It is 12 miles away. It took 30 minutes.', time.time())
+    parsed = []
+    find_units = Unit.find_units
+    monkeypatch.setattr(Unit, 'find_units', staticmethod(lambda text: parsed.append(text) or find_units(text)))
+    assert bot.comment_has_units(comment)
+    assert [found.value for found in bot.parse_comment(comment)] == [12, 30]
+    assert parsed == [comment.body]
+
+    assert bot.comment_has_units(comment)
+    assert bot.reply_comment(comment)
+    assert len(parsed) == 2
+    assert len(bot.r.replies) == 1
+    assert not bot.parsed_comments
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+"""
+Tests for the hot path instrumentation.
+
+"""
+import json
+
+import pytest
+
+import instrument
+from convert_bot import ReplyTemplate
+from fake_reddit import FakeReddit
+from loadtest import make_bot
+from replies import ReplyQueue
+from unit import Unit
+
+
+@pytest.fixture
+def enabled():
+    instrument.reset()
+    instrument.enable()
+    yield
+    instrument.disable()
+    instrument.reset()
+
+
+def test_instrument(enabled):
+    units = list(Unit.find_units("I walked 12 miles in 2 hours and 7 minutes"))
+    assert Unit.find_first_unit("5 miles") is not None
+    units[0].to_useless()
+    ReplyTemplate("{value}[!/.]")(value='1')
+    ReplyQueue(workers=0).put(FakeReddit(['hi']).get_comments('test')[0], 'hi')
+
+    stats = instrument.snapshot()
+    assert stats['counters']['units.length.miles'] == 2
+    assert stats['counters']['units.time.hours'] == 1
+    assert stats['counters']['chains.time'] == 1
+    for name in ['Unit.find_units', 'Unit.to_useless', 'ReplyTemplate.__call__', 'ReplyQueue._send']:
+        assert stats['latency'][name]['count'] >= 1
+    assert stats['latency']['Unit.find_units']['count'] == 2
+    assert 'Unit.find_units' in instrument.summary()
+
+
+def test_disable():
+    find_units = Unit.__dict__['find_units']
+    instrument.enable()
+    assert Unit.__dict__['find_units'] is not find_units
+    instrument.disable()
+    assert Unit.__dict__['find_units'] is find_units
+    assert not instrument.is_enabled()
+
+
+def test_report_to_file(enabled, tmpdir):
+    path = tmpdir.join('stats.json')
+    list(Unit.find_units("12 miles"))
+    instrument.report(str(path))
+    instrument.report(str(path))
+
+    lines = path.read().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0])['latency']['Unit.find_units']['count'] == 1
+
+
+def test_histogram():
+    histogram = instrument.Histogram()
+    for micros in range(1, 101):
+        histogram.add(micros / 1e6)
+    assert histogram.count == 100
+    assert 32e-6 <= histogram.percentile(50) <= 64e-6
+    assert histogram.percentile(99) == 128e-6
+
+
+def test_bot(tmpdir):
+    """The bot times its comment checks and reports in every loop, without mail."""
+    path = tmpdir.join('stats.json')
+    instrument.reset()
+    bot = make_bot(FakeReddit(['walked 5 miles']), str(tmpdir), {
+        'reply_workers': 0,
+        'instrument': True,
+        'stats_interval': 0,
+        'stats_file': str(path),
+    })
+    try:
+        bot.bot_start()
+        bot.loop('test')
+        # reported at the start of the next loop
+        bot.loop('test')
+        bot.bot_stop()
+    finally:
+        instrument.disable()
+        instrument.reset()
+
+    stats = json.loads(path.read().splitlines()[-1])
+    assert stats['latency']['ConvertBot.comment_has_units']['count'] == 1
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+"""
+Tests for the fake Reddit and the load test.
+
+"""
+from fake_reddit import FakeReddit
+from loadtest import format_report, make_bot, run
+
+
+TEXTS = ['it is 5 miles away', 'nothing to see', 'I weigh 80 pounds', 'he is 5 feet 3 inches'] * 25
+
+
+def test_fake_reddit():
+    reddit = FakeReddit(TEXTS[:4], subreddits=['a', 'b'])
+    comments = reddit.get_comments('a', limit=10)
+    assert [comment.body for comment in comments] == [TEXTS[0], TEXTS[2]]
+    assert reddit.get_comments('a', limit=10, params={'before': comments[0].fullname}) == comments[1:]
+    assert reddit.get_info(thing_id=comments[1].fullname) is comments[1]
+
+    assert not reddit.get_me().has_mail
+    reddit.post_message('stop', author='alice')
+    assert reddit.get_me().has_mail
+    unread = reddit.get_unread()
+    assert [message.subject for message in unread] == ['stop']
+    assert reddit.get_me().has_mail
+    unread[0].mark_as_read()
+    assert not reddit.get_me().has_mail
+
+
+def test_rate():
+    reddit = FakeReddit(TEXTS, rate=1000)
+    assert len(reddit.get_comments('test')) < len(TEXTS)
+
+
+def test_run(tmpdir):
+    reddit = FakeReddit(TEXTS, subreddits=['a', 'b'], rate_limit=0.1, sleep_time=0.001, seed=0)
+    bot = make_bot(reddit, str(tmpdir), {'reply_workers': 0})
+    report = run(bot, reddit)
+
+    assert report['comments'] == len(TEXTS)
+    assert report['replies'] == 75
+    assert report['rate_limited'] == reddit.rate_limited > 0
+    assert report['reply_latency']['p50'] <= report['reply_latency']['p99']
+    assert 'comments/s' in format_report(report)
+
+
+def test_run_messages(tmpdir):
+    reddit = FakeReddit(TEXTS)
+    bot = make_bot(reddit, str(tmpdir), {'reply_workers': 0})
+    report = run(bot, reddit, messages=4)
+    assert report['messages'] == 4
+    assert report['unread_mail']['max'] >= 1
+
+
+def test_run_messages_rate_limited(tmpdir):
+    """Rate limited message replies are tried again like do_loop does."""
+    reddit = FakeReddit(TEXTS, rate_limit=0.2, sleep_time=0.001, seed=0)
+    bot = make_bot(reddit, str(tmpdir), {'reply_workers': 0})
+    report = run(bot, reddit, messages=40)
+    assert report['messages'] == 40
+    assert report['loop_rate_limited'] > 0
+    assert not reddit.unread
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+"""
+Tests for the reply worker pool.
+
+"""
+import time
+
+from fake_reddit import FakeReddit
+from replies import ReplyQueue
+
+
+def make_comments(number, latency=0.0):
+    """Comments of a fake Reddit, replies to them take `latency` seconds."""
+    reddit = FakeReddit(['hi'] * number, sleep_time=0.05)
+    comments = reddit.get_comments('test')
+    reddit.latency = latency
+    return reddit, comments
+
+
+def test_replies_in_parallel():
+    """Slow replies don't add up with enough workers."""
+    reddit, comments = make_comments(8, latency=0.05)
+    replies = ReplyQueue(workers=8)
+    replies.start()
+
+    started = time.time()
+    for comment in comments:
+        replies.put(comment, 'hi')
+    replies.stop()
+
+    assert time.time() - started < 0.05 * 4
+    assert len(reddit.replies) == 8
+    assert replies.stats['sent'] == 8
+
+
+def test_backpressure():
+    """A full queue blocks the producer until a worker frees up a slot."""
+    reddit, comments = make_comments(4, latency=0.05)
+    replies = ReplyQueue(workers=1, size=1)
+    replies.start()
+
+    started = time.time()
+    for comment in comments:
+        replies.put(comment, 'hi')
+    # one reply in progress and one queued, the others had to wait
+    assert time.time() - started >= 0.05 * 1.5
+    replies.stop()
+
+
+def test_rate_limit():
+    """Rate limited replies pause all workers and are tried again."""
+    reddit, (limited, other) = make_comments(2)
+    reddit.fail(limited)
+    replies = ReplyQueue(workers=2)
+    replies.start()
+
+    replies.put(limited, 'hi')
+    time.sleep(0.01)
+    replies.put(other, 'hi')
+    replies.stop()
+
+    latencies = {thing: latency for thing, text, latency in reddit.replies}
+    assert set(latencies) == {limited, other}
+    assert latencies[other] >= reddit.sleep_time
+    assert replies.stats['rate_limited'] == 1
+    assert replies.stats['sent'] == 2
+
+
+def test_failed_reply():
+    reddit, (comment,) = make_comments(1)
+    reddit.fail(comment, ValueError('nope'))
+    replies = ReplyQueue(workers=0)
+    replies.put(comment, 'hi')
+    assert not reddit.replies
+    assert replies.stats['failed'] == 1
+
+
+def test_worker_session():
+    """Workers reply with a session of their own, not the one of the comment."""
+    sessions = []
+
+    def new_session():
+        sessions.append(object())
+        return sessions[-1]
+
+    reddit, (comment,) = make_comments(1)
+    replies = ReplyQueue(workers=2, session=new_session)
+    replies.start()
+    sent = []
+    replies._send = lambda thing, text: sent.append(thing.reddit_session)
+    replies.put(comment, 'hi')
+    replies.stop()
+
+    assert len(sessions) == 2
+    assert sent[0] in sessions
+    assert comment.reddit_session is reddit
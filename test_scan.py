@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+"""
+Tests for the offline comment dump scanner.
+
+"""
+import io
+import json
+
+import pytest
+
+import scan
+
+
+COMMENTS = [
+    {'id': 'a', 'body': "I walked 12 miles to have 5 minutes of peace."},
+    {'id': 'b', 'body': "Nothing to see here."},
+    {'id': 'c', 'body': "my gf is only 4'7\""},
+    {'id': 'd'},
+]
+
+
+@pytest.mark.parametrize('workers,chunk_size', [
+    (1, 1000),
+    (2, 1),
+])
+def test_scan(workers, chunk_size):
+    """Matches are written in input order, however the chunks are spread."""
+    lines = [json.dumps(comment) for comment in COMMENTS * 5] + ['not json']
+    output = io.StringIO()
+
+    stats = scan.scan(lines, output, workers=workers, chunk_size=chunk_size)
+
+    matches = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [match['id'] for match in matches] == ['a', 'c'] * 5
+    assert [match['line'] for match in matches][:2] == [0, 2]
+    assert matches[1]['units'] == [[
+        {'category': 'length', 'unit': 'feet', 'value': '4', 'span': [14, 16]},
+        {'category': 'length', 'unit': 'inches', 'value': '7', 'span': [16, 18]},
+    ]]
+    assert stats['comments'] == 15
+    assert stats['hits'] == 10
+    assert stats['invalid'] == 6
+    assert stats['units.time'] == 5
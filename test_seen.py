@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+"""
+Tests for the persistent seen comments filter.
+
+"""
+import pytest
+
+from seen import SeenFilter
+
+
+def test_add():
+    seen = SeenFilter(capacity=100)
+    assert 'abc' not in seen
+    assert not seen.add('abc')
+    assert seen.add('abc')
+    assert 'abc' in seen
+    assert len(seen) == 1
+
+
+def test_survives_restart(tmpdir):
+    path = str(tmpdir.join('seen.bin'))
+    seen = SeenFilter(path, capacity=100)
+    for i in range(50):
+        seen.add('c{}'.format(i))
+    seen.close()
+
+    seen = SeenFilter(path, capacity=100)
+    assert all('c{}'.format(i) in seen for i in range(50))
+    assert len(seen) == 50
+    seen.close()
+
+
+def test_settings_changed(tmpdir):
+    """A file made with other settings is started over."""
+    path = str(tmpdir.join('seen.bin'))
+    seen = SeenFilter(path, capacity=100)
+    seen.add('abc')
+    seen.close()
+
+    seen = SeenFilter(path, capacity=1000)
+    assert 'abc' not in seen
+    seen.close()
+
+
+def test_rotation(tmpdir):
+    """At least the last `capacity` ids are kept, and the file never grows."""
+    path = str(tmpdir.join('seen.bin'))
+    seen = SeenFilter(path, capacity=100)
+    size = tmpdir.join('seen.bin').size()
+    for i in range(1000):
+        seen.add('c{}'.format(i))
+    assert all('c{}'.format(i) in seen for i in range(900, 1000))
+    assert len(seen) <= 200
+    assert tmpdir.join('seen.bin').size() == size
+    seen.close()
+
+
+@pytest.mark.parametrize('error_rate', [0.01, 0.001])
+def test_error_rate(error_rate):
+    seen = SeenFilter(capacity=2000, error_rate=error_rate)
+    for i in range(4000):
+        seen.add('seen{}'.format(i))
+    false_positives = sum('other{}'.format(i) in seen for i in range(20000))
+    assert false_positives / 20000.0 < error_rate * 2
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+"""
+Tests for comparing unit parsers in shadow mode.
+
+"""
+import json
+
+from shadow import Shadow, load_engine, main
+from unit import Unit
+
+
+def no_chains(text):
+    """Like Unit.find_units, but chains are split up."""
+    for found in Unit.find_units(text):
+        if isinstance(found, list):
+            for chain_unit in found:
+                yield chain_unit
+        else:
+            yield found
+
+
+def broken(text):
+    raise ValueError('nope')
+
+
+def test_load_engine():
+    assert load_engine('unit:Unit.find_units') == Unit.find_units
+    assert load_engine('test_shadow:no_chains') is no_chains
+
+
+def test_same(tmpdir):
+    log = tmpdir.join('shadow.log')
+    shadow = Shadow(Unit.find_units, rate=1, path=str(log))
+    assert shadow.compare('it is 5 miles and 20 kg', id='a')
+    shadow.close()
+    entry = json.loads(log.read())
+    assert entry['id'] == 'a'
+    assert 'text' not in entry
+    assert shadow.stats == {'compared': 1}
+
+
+def test_diverged(tmpdir):
+    log = tmpdir.join('shadow.log')
+    shadow = Shadow(no_chains, rate=1, path=str(log))
+    assert shadow.compare('5 miles', id='a')
+    assert not shadow.compare('he is 5 feet 3 inches tall', id='b')
+    assert not Shadow(broken, rate=1).compare('5 miles')
+    shadow.close()
+
+    entries = [json.loads(line) for line in log.readlines()]
+    assert len(entries) == 2
+    assert entries[1]['text'] == 'he is 5 feet 3 inches tall'
+    assert len(entries[1]['ref']) == 1 and len(entries[1]['shadow']) == 2
+    assert shadow.stats['diverged'] == 1
+
+
+def test_sample_rate():
+    shadow = Shadow(Unit.find_units, rate=0.25, seed=1)
+    for i in range(1000):
+        shadow.maybe_compare('5 miles')
+    assert 150 < shadow.stats['compared'] < 350
+    shadow = Shadow(Unit.find_units, rate=0)
+    shadow.maybe_compare('5 miles')
+    assert not shadow.stats['compared']
+
+
+def test_replay(tmpdir):
+    dump = tmpdir.join('comments.json')
+    dump.write('\n'.join(json.dumps({'id': str(i), 'body': body}) for i, body in enumerate(
+        ['5 miles', 'nothing here', '5 feet 3 inches'])))
+    assert main([str(dump), '--engine', 'unit:Unit.find_units']) == 0
+    assert main([str(dump), '--engine', 'test_shadow:no_chains']) == 1
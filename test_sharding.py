@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+"""
+Tests for sharding subreddits between several bots.
+
+"""
+import os
+import time
+from collections import Counter
+
+import pytest
+from praw.errors import Forbidden
+
+from fake_reddit import FakeReddit
+from loadtest import make_bot as make_convert_bot
+from sharding import FileCoordinator, HashRing, Shard
+
+
+SUBREDDITS = ['sub{}'.format(i) for i in range(40)]
+
+
+def test_ring_balance():
+    ring = HashRing(['a', 'b', 'c', 'd'])
+    owners = Counter(ring.owner('r/{}'.format(i)) for i in range(4000))
+    assert set(owners) == {'a', 'b', 'c', 'd'}
+    assert min(owners.values()) > 500
+
+
+def test_ring_consistent():
+    """When a shard joins, only keys moving to that shard change owner."""
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b', 'c', 'd'])
+    for i in range(1000):
+        key = 'r/{}'.format(i)
+        assert after.owner(key) in (before.owner(key), 'd')
+    assert HashRing([]).owner('r/test') is None
+
+
+def test_coordinator(tmpdir):
+    a = FileCoordinator(str(tmpdir), 'a', timeout=60)
+    b = FileCoordinator(str(tmpdir), 'b', timeout=60)
+    a.heartbeat()
+    b.heartbeat()
+    assert a.members() == {'a', 'b'}
+
+    old = time.time() - 120
+    os.utime(os.path.join(str(tmpdir), 'shards', 'b'), (old, old))
+    assert a.members() == {'a'}
+
+    a.send('b', {'n': 1})
+    a.send('b', {'n': 2})
+    assert list(b.receive()) == [{'n': 1}, {'n': 2}]
+    assert list(b.receive()) == []
+
+
+def test_shard_refresh(tmpdir):
+    a = Shard(FileCoordinator(str(tmpdir), 'a'), interval=0)
+    assert not a.refresh()
+    assert a.ring.shards == {'a'}
+    b = Shard(FileCoordinator(str(tmpdir), 'b'), interval=0)
+    b.refresh()
+    assert a.refresh()
+    assert a.ring.shards == {'a', 'b'}
+    b.leave()
+    assert a.refresh()
+    assert a.ring.shards == {'a'}
+
+
+class FakeMessage(object):
+    def __init__(self, subject):
+        self.subject = subject
+        self.replies = []
+        self.read = False
+
+    def reply(self, text):
+        self.replies.append(text)
+
+    def mark_as_read(self):
+        self.read = True
+
+
+@pytest.fixture
+def make_bot(tmpdir):
+    bots = []
+
+    def make_bot(shard_id):
+        bot = make_convert_bot(FakeReddit([], subreddits=SUBREDDITS), str(tmpdir), {
+            'reply_workers': 0,
+            'shard_dir': str(tmpdir.join('shards')),
+            'shard_id': shard_id,
+            'shard_interval': 0,
+        }, blocked_users=['troll'])
+        bot.bot_start()
+        bots.append(bot)
+        return bot
+
+    yield make_bot
+    for bot in bots:
+        bot.bot_stop()
+
+
+def test_rebalance(make_bot):
+    a = make_bot('a')
+    assert a.subreddits == set(SUBREDDITS)
+
+    b = make_bot('b')
+    a.refresh()
+    assert a.subreddits and b.subreddits
+    assert a.subreddits | b.subreddits == set(SUBREDDITS)
+    assert not a.subreddits & b.subreddits
+
+    b.bot_stop()
+    a.refresh()
+    assert a.subreddits == set(SUBREDDITS)
+
+
+def test_forward_message(make_bot):
+    a = make_bot('a')
+    b = make_bot('b')
+    a.refresh()
+    subreddit = next(name for name in ('new{}'.format(i) for i in range(100))
+                     if b.shard.owns('r/' + name))
+
+    message = FakeMessage('start')
+    a.on_subreddit_message(subreddit, message)
+    assert message.read and not message.replies
+    assert subreddit not in a.subreddits
+
+    assert b.loop(subreddit) == b.BOT_SHOULD_REFRESH
+    b.refresh()
+    assert subreddit in b.subreddits
+    assert b.r.sent == [('/r/' + subreddit, 're: start',
+                         "Hey /r/{}! you are now whitelisted for me! yay!".format(subreddit))]
+    assert subreddit in b._get_subreddits()
+
+
+def test_forward_user_message(make_bot):
+    """A user blocked through another shard is blocked on every shard."""
+    a = make_bot('a')
+    b = make_bot('b')
+    a.refresh()
+    user = next(name for name in ('user{}'.format(i) for i in range(100))
+                if b.shard.owns('u/' + name))
+
+    message = FakeMessage('stop')
+    a.on_user_message(user, message)
+    assert message.read and not message.replies
+    assert not a.is_user_blocked(user)
+
+    b.sync_shard()
+    assert b.is_user_blocked(user)
+    a.sync_shard()
+    assert a.is_user_blocked(user)
+
+
+def test_shared_file(make_bot):
+    """Shards removing names from the same file keep each other's changes."""
+    a = make_bot('a')
+    b = make_bot('b')
+    a.refresh()
+    removed_a = sorted(a.subreddits)[0]
+    removed_b = sorted(b.subreddits)[0]
+
+    a.before_mail_check()
+    a.on_subreddit_message(removed_a, FakeMessage('stop'))
+    b.before_mail_check()
+    b.on_subreddit_message(removed_b, FakeMessage('stop'))
+    a.after_mail_check()
+    b.after_mail_check()
+
+    assert a._get_subreddits() == set(SUBREDDITS) - {removed_a, removed_b}
+
+
+def test_forbidden_subreddit(make_bot, monkeypatch):
+    """A forbidden subreddit is removed from the file, the others are kept."""
+    a = make_bot('a')
+    make_bot('b')
+    a.refresh()
+    assert a.subreddits != set(SUBREDDITS)
+
+    def forbidden(subreddit, limit=None, params=None):
+        raise Forbidden(None)
+    monkeypatch.setattr(a.r, 'get_comments', forbidden)
+    subreddit = next(iter(a.subreddits))
+    a.do_loop()
+
+    assert subreddit not in a.subreddits
+    assert a._get_subreddits() == set(SUBREDDITS) - {subreddit}
@@ -5,6 +5,10 @@ from __future__ import unicode_literals
 Tests for the Unit class and utility methods.
 
 """
+import os
+import random
+import re
+import sys
 from decimal import Decimal
 
 import pytest
@@ -13,15 +17,16 @@ import unit
 from unit import Unit
 
 
-@pytest.mark.parametrize('value,expected', [
+NUMBERS = [
     ('42', Decimal(42)),
     ('123456', Decimal(123456)),
     ('60,018', Decimal(60018)),
     ('70 018', Decimal(70018)),
     ('160,018', Decimal(160018)),
     ('43,778,147.0000016', Decimal('43778147.0000016')),
-])
-@pytest.mark.parametrize('unit,templates', [
+]
+
+UNIT_TEMPLATES = [
     (unit.METERS, ['{} meter', '{}metres']),
     (unit.KILOMETERS, ['{}km', '{} kilometer', '{}kilometres']),
     (unit.INCHES, ['{} inches', '{}inch', '{}in', '{}" wide']),
@@ -51,17 +56,98 @@ from unit import Unit
     (unit.KILOWATTS, ['{}kW', '{} kilowatt']),
     (unit.WATTS, ['{} watt', '{} watts']),
     (unit.HP, ['{}HP', '{} WHP', '{} horsepower']),
-])
+]
+
+
+@pytest.mark.parametrize('value,expected', NUMBERS)
+@pytest.mark.parametrize('unit,templates', UNIT_TEMPLATES)
 def test_unit_detection(value, expected, unit, templates):
     """Testing different combinations of number formats and all units."""
     for template in templates:
         text = template.format(value)
+        assert Unit.may_have_units(text)
         found_unit = Unit.find_first_unit(text)
         assert found_unit is not None, 'Nothing found in {!r}'.format(text)
         assert found_unit.value == expected and found_unit.unit == unit
         assert isinstance(found_unit.to_useless(), type(''))
 
 
+@pytest.mark.parametrize('value,expected', NUMBERS)
+@pytest.mark.parametrize('unit_name,templates', UNIT_TEMPLATES)
+def test_numeric_backends(value, expected, unit_name, templates):
+    """The float backend formats the same values as the Decimal backend."""
+    for template in templates:
+        text = template.format(value)
+        outputs = []
+        for backend in (unit.DECIMAL, unit.FLOAT):
+            unit.set_backend(backend)
+            try:
+                random.seed(text)
+                outputs.append([
+                    [u.get_original_string(), unit.prettify(u.value)] +
+                    [unit.prettify(unit.convert(u.value, u.category, names[0]))
+                     for names, factor in unit.USELESS_UNITS[u.category]]
+                    for u in Unit.find_normalized(text)
+                ])
+            finally:
+                unit.set_backend(unit.DECIMAL)
+        assert outputs[0] == outputs[1]
+
+
+def _reference_prettify(value, places=6, sep=',', dp='.', pos='', neg='-'):
+    """The original digit by digit implementation of `prettify`."""
+    q = Decimal(10) ** -places
+    sign, digits, exp = value.quantize(q).as_tuple()
+    result = []
+    digits = list(map(str, digits))
+    build, next = result.append, digits.pop
+    for i in range(places):
+        build(next() if digits else '0')
+    build(dp)
+    if not digits:
+        build('0')
+    i = 0
+    while digits:
+        build(next())
+        i += 1
+        if i == 3 and digits:
+            i = 0
+            build(sep)
+    build(neg if sign else pos)
+
+    if value < 1:
+        pass
+    elif value < 10:
+        result = result[places - 2:]
+    elif value > 99000000:
+        result = [' million'] + result[9 + places:]
+    else:
+        result = result[places + 1:]
+
+    formatted = ''.join(reversed(result))
+    if '.' in formatted:
+        return formatted.rstrip('.0')
+    return formatted
+
+
+# set PRETTIFY_SAMPLES=1000000 for a thorough run
+PRETTIFY_SAMPLES = int(os.environ.get('PRETTIFY_SAMPLES', 20000))
+
+
+@pytest.mark.parametrize('number', [Decimal, float])
+def test_prettify(number):
+    """prettify formats random values of all sizes like the original implementation."""
+    rng = random.Random(number.__name__)
+    for i in range(PRETTIFY_SAMPLES):
+        value = number(Decimal(rng.randrange(10 ** rng.randint(1, 16))).scaleb(-rng.randint(0, 12)))
+        if rng.random() < 0.1:
+            value = -value
+        args = rng.choice([(), (3, '.', ','), (6, ' ', ',', '+')])
+        expected = _reference_prettify(Decimal(value), *args)
+        assert unit.prettify(value, *args) == expected, (value, args)
+        assert unit.prettify(value, *args) == expected, (value, args)
+
+
 @pytest.mark.parametrize('text,expected_units', [
     ("I walked 12 miles to have 5 minutes of peace.",
         [Unit(unit.LENGTH, 12, unit=unit.MILES), Unit(unit.TIME, 5, unit=unit.MINUTES)]),
@@ -79,6 +165,17 @@ def test_unit_detection(value, expected, unit, templates):
         [[Unit(unit.TIME, 1, unit=unit.HOURS), Unit(unit.TIME, 12, unit=unit.MINUTES), Unit(unit.TIME, 7, unit=unit.SECONDS)]]),  # noqa
     ("ships passed within 12 nautical miles of the U.S.-held Aleutian Islands off Alaska In September",
         [Unit(unit.LENGTH, 12, unit=unit.NAUT_MILES)]),
+    ("I ran 5 miles today, tomorrow I'll run 10 miles",
+        [Unit(unit.LENGTH, 5, unit=unit.MILES), Unit(unit.LENGTH, 10, unit=unit.MILES)]),
+    ("I live on 8 mile road, which is 12 miles long",
+        [Unit(unit.LENGTH, 12, unit=unit.MILES)]),
+    ("I slept 7 hours and 12 minutes, then ran 1 hour, 3 minutes and 12 seconds",
+        [[Unit(unit.TIME, 7, unit=unit.HOURS), Unit(unit.TIME, 12, unit=unit.MINUTES)],
+         [Unit(unit.TIME, 1, unit=unit.HOURS), Unit(unit.TIME, 3, unit=unit.MINUTES), Unit(unit.TIME, 12, unit=unit.SECONDS)]]),  # noqa
+    ("she is 5'4\" and he is 6ft 2in", [
+        [Unit(unit.LENGTH, 5, unit=unit.FEET), Unit(unit.LENGTH, 4, unit=unit.INCHES)],
+        [Unit(unit.LENGTH, 6, unit=unit.FEET), Unit(unit.LENGTH, 2, unit=unit.INCHES)]]),
+    ("12 seconds and 3 minutes", [Unit(unit.TIME, 12, unit=unit.SECONDS), Unit(unit.TIME, 3, unit=unit.MINUTES)]),
     ("you might as well go 0 mph", []),
     ("Only us true 90's kids played it like that.", []),
     ("they just want to press \"4\", \"3\" maybe  \"w\" and win.", []),
@@ -87,6 +184,109 @@ def test_text_detection(text, expected_units):
     """Make sure we detect all mentioned units anywhere in a text."""
     found_units = list(Unit.find_units(text))
     assert found_units == expected_units
+    assert Unit.may_have_units(text) or not found_units
+
+
+def test_iter_units():
+    """All units are found in order of appearance, along with their position."""
+    text = "3 minutes, 12km, then 2 minutes later another 12km"
+    units = Unit.iter_units(text)
+
+    first = next(units)
+    assert first == Unit(unit.TIME, 3, unit=unit.MINUTES)
+    assert text[slice(*first.span)] == '3 minutes'
+    assert [(u.unit, u.value, text[slice(*u.span)]) for u in units] == [
+        (unit.KILOMETERS, Decimal(12), '12km'),
+        (unit.MINUTES, Decimal(2), '2 minutes'),
+        (unit.KILOMETERS, Decimal(12), '12km'),
+    ]
+
+
+@pytest.mark.parametrize('text', [
+    "Nothing to see here.",
+    "I have 3 cats and 2 dogs.",
+    "Back in 2015, top 10 lists were all the rage.",
+    "Only us true 90s kids played it like that.",
+    "He moved there in 1990 in Texas.",
+    "See page 4, section 2.",
+    "It was over in 1 second.",
+    "The town has 500 inhabitants.",
+    "Only us true 90's kids played it like that.",
+    "they just want to press \"4\", \"3\" maybe \"w\" and win.",
+])
+def test_may_have_units(text):
+    """Texts without a digit followed by a unit keyword are rejected without any regex."""
+    assert not Unit.may_have_units(text)
+
+
+@pytest.mark.parametrize('text', [
+    "it's 5in long",
+    "she is 5'4\" tall",
+    "1,000 miles",
+    "about 1.5km away",
+    "wait 10 seconds",
+    "'5 miles' was the answer",
+    "3 feet, 2 inches",
+])
+def test_may_have_units_kept(text):
+    """Whatever the unit patterns allow around a keyword isn't rejected."""
+    assert Unit.may_have_units(text)
+    assert Unit.has_units(text)
+
+
+@pytest.mark.parametrize('text,blacklisted', [
+    ("keep it 10ft away", True),
+    ("keep it 10 ft away", True),
+    ("keep it 10.0 feet away", True),
+    ("keep it 11 ft away", False),
+    ("open 24 hour a day", True),
+    ("the whole 9 yards", True),
+    ("1,000 yard stare", True),
+])
+def test_blacklist(text, blacklisted):
+    """A blacklist entry covers all spellings of its number and unit."""
+    assert (list(Unit.iter_units(text)) == []) == blacklisted
+
+
+def test_load_blacklist(tmpdir, monkeypatch):
+    monkeypatch.setattr(unit, 'BLACKLIST_INDEX', unit.BLACKLIST_INDEX)
+    monkeypatch.setattr(unit, '_BLACKLIST_FILE_ENTRIES', unit._BLACKLIST_FILE_ENTRIES)
+    path = tmpdir.join('blacklist.txt')
+    path.write('# idioms\n\n500 miles\nnot a unit\n')
+
+    unit.load_blacklist(str(path))
+    assert not list(Unit.iter_units("I would walk 500 miles"))
+    assert not list(Unit.iter_units("the whole 9 yards"))
+
+    path.write('3 minutes\n')
+    unit.load_blacklist(str(path))
+    assert list(Unit.iter_units("I would walk 500 miles"))
+    assert not list(Unit.iter_units("wait 3 min"))
+
+
+@pytest.mark.parametrize('text', [
+    "I walked 12 miles to have 5 minutes of peace.",
+    "my gf is only 4'7\"",
+    "you might as well go 0 mph",
+    "keep it 10 ft away",
+    "keep it 10 ft away, or 11 ft",
+    "1,000 yard stare",
+    "0.000 miles",
+    "1,008 mile",
+    "Only us true 90's kids played it like that.",
+])
+def test_has_units(text):
+    """has_units answers like find_units without parsing any units."""
+    assert Unit.has_units(text) == any(Unit.find_units(text))
+
+
+def test_has_units_order(monkeypatch):
+    """Units that are detected a lot are tried first."""
+    monkeypatch.setattr(unit, '_UNIT_HITS', unit.Counter())
+    monkeypatch.setattr(unit, '_DETECT_GROUPS', unit._DETECT_GROUPS)
+    for i in range(unit._DETECT_SORT_INTERVAL):
+        assert Unit.has_units("a {} hp engine".format(i + 1))
+    assert unit._DETECT_GROUPS[0][2] == unit.HP
 
 
 @pytest.mark.parametrize('values,expected', [
@@ -124,3 +324,233 @@ def test_compound_units(values, expected, units, template):
 def test_normalize(unit1, unit2):
     """Conversion in the same category but with different units should work."""
     assert unit1 == unit2
+
+
+@pytest.mark.parametrize('text', [
+    "I walked 12 miles to have 5 minutes of peace.",
+    "17 minutes into 8 Mile and I already love it.",
+    "my gf is only 4'7\"",
+    "I have waited 1 hour, 12 minutes and 7 seconds",
+    "ships passed within 12 nautical miles of the coast",
+    "they just want to press \"4\", \"3\" maybe  \"w\" and win.",
+    "he ran 5 meters a second for 1,042ft and then '4 ft more",
+    "version 5.5.5 km, 1 000 000 liters and 2 000kg",
+    "12 km, 13 km/h, 14 kilometers per hour and 15 kilometres",
+])
+def test_scanner(text):
+    """The single-pass scanner finds the same first match as every unit pattern on its own."""
+    found = {}
+    for category, unit_name, match_text, number, span in unit._scan(text):
+        found.setdefault(unit_name, (match_text, number, span))
+
+    for category, units in unit.UNIT_TABLE.items():
+        for unit_name, (regex, factor) in units.items():
+            match = regex.search(text)
+            expected = (match.group(0), match.group(1), match.span()) if match else None
+            assert found.get(unit_name) == expected, unit_name
+
+
+def _regex_numbers(text):
+    """The numbers RE_NUM matches where the scanner used to look for units."""
+    regex = re.compile(r'(?=\d)(?=' + unit.RE_NUM + r')\d+')
+    return [match.span(1) for match in regex.finditer(text)]
+
+
+@pytest.mark.parametrize('text', [
+    "1,234,567.89 and 1 234 567",
+    "1,2345 and 12,345,6789 and 1234,567",
+    "a1,234 _12 x 3.4.5 6..7 8,,999",
+    "123,456,789," * 5 + "1",
+    "٣٤٥,٦٧٨ and 1, 234 and 1 ,234",
+])
+def test_numbers(text):
+    """The tokenizer finds the numbers RE_NUM does."""
+    assert list(unit._numbers(text)) == _regex_numbers(text)
+
+
+def test_numbers_random():
+    rng = random.Random(0)
+    chars = '0123456789' * 2 + ' ,.a_'
+    for i in range(2000):
+        text = ''.join(rng.choice(chars) for j in range(rng.randint(1, 30)))
+        assert list(unit._numbers(text)) == _regex_numbers(text), text
+
+
+def test_numbers_lazy(monkeypatch):
+    """The first unit of a long text is found without looking at the rest of it."""
+    runs = []
+    compile_digit_runs = unit._compile_digit_runs
+
+    class CountedRuns(object):
+        def __init__(self, regex):
+            self.regex = regex
+
+        def finditer(self, text):
+            for match in self.regex.finditer(text):
+                runs.append(match)
+                yield match
+
+    monkeypatch.setattr(unit, '_compile_digit_runs', lambda keywords: CountedRuns(compile_digit_runs(keywords)))
+    text = "5 miles " + "1 mi " * 1000
+    assert next(Unit.iter_units(text)).span == (0, 7)
+    assert Unit.has_units(text)
+    assert len(runs) <= 4
+
+
+@pytest.mark.parametrize('text', [
+    "123,456," * 2000 + "5 miles",
+    "123 " * 2000 + "feet",
+    "1.2." * 2000 + "3 pounds",
+], ids=['commas', 'spaces', 'decimals'])
+def test_scanner_long_numbers(text):
+    units = list(Unit.find_units(text))
+    assert len(units) == 1
+    assert units[0].end == len(text)
+
+
+def test_max_scan_numbers(monkeypatch):
+    monkeypatch.setattr(unit, 'MAX_SCAN_NUMBERS', 3)
+    text = '1 mile, 2 miles, 3 miles, 4 miles'
+    assert len(list(Unit.find_units(text))) == 3
+
+
+@pytest.mark.parametrize('value,from_unit,to_unit,expected', [
+    (Decimal(3), unit.KILOMETERS, unit.METERS, Decimal(3000)),
+    (Decimal(5), unit.MILES, unit.KILOMETERS, Decimal('8.0467')),
+    (Decimal(2), unit.HOURS, unit.TIME, Decimal(7200)),
+    (Decimal(1), unit.LENGTH, 'smoot', Decimal('0.587613116')),
+    (Decimal(10), unit.FEET, 'smoot', Decimal('1.791044778')),
+    (4.0, unit.POUNDS, unit.KILOGRAMS, Decimal('1.814368')),
+])
+def test_convert(value, from_unit, to_unit, expected):
+    """Units convert directly into any other unit of their category."""
+    converted = unit.convert(value, from_unit, to_unit)
+    assert isinstance(converted, type(value))
+    assert round(Decimal(converted), 6) == round(expected, 6)
+
+
+def test_convert_category_mismatch():
+    with pytest.raises(ValueError):
+        unit.convert(Decimal(1), unit.MILES, unit.KILOGRAMS)
+
+
+BATCH_TEXTS = [
+    "I walked 12 miles to have 5 minutes of peace.",
+    "Nothing to see here.",
+    "my gf is only 4'7\"",
+]
+
+
+def _check_batch(batch):
+    assert list(batch.index) == [0, 0, 2, 2]
+    assert list(batch.unit) == [unit.MILES, unit.MINUTES, unit.FEET, unit.INCHES]
+    assert list(batch.value) == [12, 5, 4, 7]
+    assert [round(float(value), 4) for value in batch.normal] == [19312.08, 300, 1.2192, 0.1778]
+    assert BATCH_TEXTS[0][batch.start[0]:batch.end[0]] == '12 miles'
+
+
+def test_find_units_batch():
+    """Batches of texts are parsed into columns, with NumPy if it is available."""
+    pytest.importorskip('numpy')
+    _check_batch(Unit.find_units_batch(BATCH_TEXTS))
+
+
+def test_find_units_batch_without_numpy(monkeypatch):
+    monkeypatch.setattr(unit, '_import_numpy', lambda: None)
+    batch = Unit.find_units_batch(BATCH_TEXTS)
+    assert isinstance(batch.index, list)
+    _check_batch(batch)
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Put back all unit categories after the test."""
+    for name in ['UNIT_TABLE', 'USELESS_UNITS', 'NAMES', 'UNIT_CHAINS', 'CONVERSIONS',
+                 '_FLOAT_CONVERSIONS', 'UNIT_CODES', '_NORMAL_FACTORS', '_FLOAT_NORMAL_FACTORS',
+                 '_LOADED_CATEGORIES']:
+        monkeypatch.setattr(unit, name, type(getattr(unit, name))(getattr(unit, name)))
+    for name in ['_NORMAL_FACTORS_ARRAY', 'CHAIN_PREFIXES', 'SCANNER', 'SCANNER_GROUPS',
+                 'KEYWORDS', 'KEYWORD_RULES', 'BLACKLIST_INDEX', '_DETECT_GROUPS']:
+        monkeypatch.setattr(unit, name, getattr(unit, name, None))
+    monkeypatch.delitem(sys.modules, 'fuel_economy', raising=False)
+
+
+def test_register_category(registry):
+    """Categories from modules and data files are found like the built-in ones."""
+    unit.load_categories('fuel_economy')
+    unit.load_categories('money.json')
+    unit.load_categories('money.json')
+
+    text = "my car does 30 mpg, and I paid 20 bucks for 12 miles of gas"
+    assert Unit.may_have_units(text)
+    assert Unit.has_units("it's just 5 bucks")
+    assert list(Unit.find_units(text)) == [
+        Unit('fuel economy', 30, unit='mpg'),
+        Unit('money', 20, unit='dollars'),
+        Unit(unit.LENGTH, 12, unit=unit.MILES),
+    ]
+    assert round(unit.convert(Decimal(10), 'km/l', 'mpg'), 4) == Decimal('23.5214')
+    assert Unit('money', 20, unit='dollars').to_useless().endswith(
+        ('Big Macs', 'months of Netflix', 'Honus Wagner baseball cards'))
+    assert Unit.find_units_batch([text]).unit[1] == 'dollars'
+
+    with pytest.raises(ValueError):
+        unit.register_category('money', [])
+    with pytest.raises(ValueError):
+        unit.register_category('more money', [('dollars', (unit.r(r' ?dollars\b'), Decimal(1)))])
+
+
+def test_lazy_patterns():
+    pattern = unit.r(r' ?parsecs?\b')
+    assert pattern._regex is None
+    assert pattern.search("12 parsecs").group(1) == '12'
+    assert pattern._regex is not None
+
+
+def test_matcher_cache(registry, tmpdir, monkeypatch):
+    """Derived tables are read from the cache instead of built again."""
+    monkeypatch.setattr(unit, 'MATCHER_CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(unit, '_matcher_cache', (None, None))
+    text = "I walked 12 miles to have 5 minutes of peace."
+    expected = list(Unit.find_units(text))
+
+    unit.SCANNER = None
+    unit._compile_matcher()
+    assert len(tmpdir.listdir()) == 1
+    keywords = unit.KEYWORDS
+
+    def fail(*args):
+        raise AssertionError('not cached')
+
+    for name in ['_compile_scanner', '_compile_keywords', '_compile_blacklist']:
+        monkeypatch.setattr(unit, name, fail)
+    monkeypatch.setattr(unit, '_matcher_cache', (None, None))
+    unit.SCANNER = None
+    assert list(Unit.find_units(text)) == expected
+    assert unit.KEYWORDS == keywords
+    assert not list(Unit.iter_units("the whole 9 yards"))
+
+    # other definitions don't use the same cache
+    monkeypatch.setattr(unit, 'BLACKLIST', unit.BLACKLIST + ['5 minutes'])
+    assert unit._load_matcher_cache() is None
+
+
+def test_matcher_cache_file(registry, tmpdir, monkeypatch):
+    """The cache is plain JSON with the exact tables, broken files are ignored."""
+    monkeypatch.setattr(unit, 'MATCHER_CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(unit, '_matcher_cache', (None, None))
+    unit.SCANNER = None
+    unit._compile_matcher()
+    path, = tmpdir.listdir()
+    assert path.ext == '.json'
+
+    cached = unit._load_matcher_cache()
+    assert cached['blacklist_index'] == unit.BLACKLIST_INDEX
+    assert cached['conversions'] == unit.CONVERSIONS
+    assert cached['float_conversions'] == unit._FLOAT_CONVERSIONS
+
+    path.write('{"scanner": ')
+    monkeypatch.setattr(unit, '_matcher_cache', (None, None))
+    assert unit._load_matcher_cache() is None
+    path.write('{}')
+    assert unit._load_matcher_cache() is None
@@ -1,21 +1,62 @@
 # -*- encoding: utf-8 -*-
 from __future__ import unicode_literals
 
+import hashlib
+import importlib
+import io
+import json
+import mmap
+import os
 import re
 import logging
+import sys
+import threading
 
-from collections import OrderedDict
+from collections import Counter, OrderedDict, namedtuple
 from decimal import Decimal
+from functools import lru_cache
 from random import choice
 
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
 
 logger = logging.getLogger(__name__)
 
 
 RE_NUM = r"\b((?:\d{1,3}(?:[ ,]\d{3})+|\d+)(?:\.\d+)?)"
+RE_FLAGS = re.IGNORECASE | re.MULTILINE
+
+
+class LazyPattern(object):
+    """
+    A regex that is only compiled when it's used for the first time.
+
+    Unit patterns are mostly needed as part of the combined SCANNER, so
+    importing a module of unit categories doesn't compile each of them.
+
+    """
+    __slots__ = ('pattern', 'flags', '_regex')
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self._regex = None
+
+    def __getattr__(self, name):
+        if self._regex is None:
+            self._regex = re.compile(self.pattern, flags=self.flags)
+        return getattr(self._regex, name)
+
+    def __repr__(self):
+        return 'LazyPattern({!r})'.format(self.pattern)
 
-r = lambda exp: re.compile(RE_NUM + exp if RE_NUM not in exp else exp,
-                           flags=re.IGNORECASE | re.MULTILINE)
+
+r = lambda exp: LazyPattern(RE_NUM + exp if RE_NUM not in exp else exp,
+                            flags=RE_FLAGS)
 
 
 # ######################################
@@ -70,7 +111,7 @@ UNIT_TABLE = {
         (METERS, (r(r' ?(?:meters?|metres?)(?! per| an| ?/ ?)\b'), Decimal('1'))),
         (MILES, (r(r'(?!naut\.?|nautical) ?mi(?:les?)?(?! per| an| ?/ ?)\b'), Decimal('1609.34'))),
         (YARDS, (r(r' ?(?:yards?|yd)\b'), Decimal('0.9144'))),
-        (FEET, (r(r"(?<!')" + RE_NUM + r"(?:'[^a-z]| ?feet\b| ?ft\b)"), Decimal('0.3048'))),
+        (FEET, (r(r"(?<!')" + RE_NUM + r"(?:'(?=[^a-z])| ?feet\b| ?ft\b)"), Decimal('0.3048'))),
         (INCHES, (r(r'(?<!")' + RE_NUM + r'(?:"[^a-z]?|in\b| ?inch\b| ?inches\b)'), Decimal('0.0254'))),
         (NAUT_MILES, (r(r' ?(?:nmi|naut\.? miles?|nautical miles?)(?! per| an| ?/ ?)\b'), Decimal('1852.00'))),
     ]),
@@ -107,7 +148,7 @@ UNIT_TABLE = {
         (WATTS, (r(r' ?watts?\b'), Decimal('1000'))),
         (HP, (r(r' ?(?:hp|bhp|whp|horse ?power)\b'), Decimal('0.745699872'))),
     ]),
-    # IDEAS: gas mileage, money
+    # more categories can be added with register_category(), e.g. fuel_economy.py
 }
 
 # compound unit chains, e.g. 5'4" or 3 minutes 12 seconds
@@ -127,10 +168,20 @@ CHAIN_WORDS = [
 ]
 
 
-def _get_chain(category, unit, index):
-    for chain in UNIT_CHAINS[category]:
-        if len(chain) > index and chain[index] == unit:
-            return chain
+def _chain_prefixes(chains):
+    """
+    Set of unit tuples that start a chain, e.g. ``(HOURS,)`` and
+    ``(HOURS, MINUTES)`` for the chain ``[HOURS, MINUTES, SECONDS]``.
+
+    """
+    return frozenset(tuple(chain[:length])
+                     for category_chains in chains.values()
+                     for chain in category_chains
+                     for length in range(1, len(chain) + 1))
+
+
+CHAIN_PREFIXES = _chain_prefixes(UNIT_CHAINS)
+_CHAIN_GAPS = frozenset(CHAIN_WORDS + [''])
 
 
 USELESS_UNITS = {
@@ -204,19 +255,16 @@ NAMES = {
     HP: ['hp', ' horsepower'],
 }
 
+# one entry covers all spellings of the same number and unit, see BLACKLIST_INDEX
 BLACKLIST = [
     '1ft',
-    '1 ft',
     '10ft',  # 10-foot pole
-    '10 foot',
     '2 feet',
     '9 yards',  # whole nine yards
     '1000 yard',  # thousand-yard stare
     '8 mile',  # another movie
     '12oz',  # some graffiti community
-    '24 hour',
     '24 hours',
-    '1 day',
     '7 days',
     '30 days',
     '365 days',
@@ -224,68 +272,821 @@ BLACKLIST = [
 ]
 
 
+DECIMAL = 'decimal'
+FLOAT = 'float'
+
+# Decimal is exact, float is a lot faster and precise enough for a reply
+NUMBER_TYPES = {
+    DECIMAL: Decimal,
+    FLOAT: float,
+}
+
+# number type of parsed values, see set_backend()
+_number = Decimal
+
+
+def _build_conversions(category, number):
+    """
+    Map every ``(from_unit, to_unit)`` pair of a category to a single factor.
+
+    Units are the units of UNIT_TABLE, the names of USELESS_UNITS and the
+    category itself, which stands for its normal unit.
+
+    """
+    to_normal = {category: number(1)}
+    for unit, (regex, factor) in UNIT_TABLE[category].items():
+        to_normal[unit] = number(factor)
+
+    from_normal = {unit: 1 / factor for unit, factor in to_normal.items()}
+    for names, factor in USELESS_UNITS.get(category, []):
+        if not callable(factor):
+            from_normal.update((name, number(factor)) for name in names)
+
+    conversions = {}
+    for from_unit, to_factor in to_normal.items():
+        for to_unit, from_factor in from_normal.items():
+            conversions[from_unit, to_unit] = to_factor * from_factor
+    return conversions
+
+
+CONVERSIONS = {}
+_FLOAT_CONVERSIONS = {}
+
+# units by number, with their factors to normalize, for vectorized conversions
+UNIT_CODES = OrderedDict()
+_NORMAL_FACTORS = []
+_FLOAT_NORMAL_FACTORS = []
+# the float factors as an array, built by find_units_batch on first use
+_NORMAL_FACTORS_ARRAY = None
+
+
+@lru_cache(maxsize=None)
+def _import_numpy():
+    """NumPy for find_units_batch, or None if it isn't installed. Only imported when needed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _add_category(category, conversions=True):
+    """Add the conversions and unit codes of a category of UNIT_TABLE."""
+    global _NORMAL_FACTORS_ARRAY
+    if conversions:
+        CONVERSIONS.update(_build_conversions(category, Decimal))
+        _FLOAT_CONVERSIONS.update(_build_conversions(category, float))
+    for unit, (regex, factor) in UNIT_TABLE[category].items():
+        UNIT_CODES[unit] = len(UNIT_CODES)
+        _NORMAL_FACTORS.append(factor)
+        _FLOAT_NORMAL_FACTORS.append(float(factor))
+    _NORMAL_FACTORS_ARRAY = None
+
+
+# columns of Unit.find_units_batch()
+UnitBatch = namedtuple('UnitBatch', ['index', 'category', 'unit', 'value', 'normal', 'start', 'end'])
+
+
+def set_backend(backend):
+    """Select the numeric backend (DECIMAL or FLOAT) used for parsed values."""
+    global _number
+    if backend not in NUMBER_TYPES:
+        raise ValueError('unknown numeric backend {}'.format(backend))
+    _number = NUMBER_TYPES[backend]
+
+
+def convert(value, from_unit, to_unit):
+    """
+    Convert a value between two units of the same category.
+
+    Takes units from UNIT_TABLE, names of USELESS_UNITS or a category for its
+    normal unit, e.g. ``convert(Decimal(3), MILES, 'smoot')``. The result has
+    the number type of the value.
+
+    """
+    conversions = _FLOAT_CONVERSIONS if isinstance(value, float) else CONVERSIONS
+    try:
+        return value * conversions[from_unit, to_unit]
+    except KeyError:
+        raise ValueError('cannot convert {} to {}'.format(from_unit, to_unit))
+
+
+def _as_decimal(value):
+    """Decimal with as many places as the shortest repr of a float."""
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return value
+
+
 def _parse_num(text):
     """Treat dots as decimal separators."""
     cleaned = text.replace(',', '').replace(' ', '').replace("'", '')
-    return Decimal(cleaned)
+    return _number(cleaned)
 
 
-def prettify(value, places=6, sep=',', dp='.', pos='', neg='-'):
-    q = Decimal(10) ** -places
-    sign, digits, exp = value.quantize(q).as_tuple()
-    result = []
-    digits = map(str, digits)
-    build, next = result.append, digits.pop
-    for i in range(places):
-        build(next() if digits else '0')
-    build(dp)
-    if not digits:
-        build('0')
-    i = 0
-    while digits:
-        build(next())
-        i += 1
-        if i == 3 and digits:
-            i = 0
-            build(sep)
-    build(neg if sign else pos)
+def _num_key(text):
+    """Canonical string of a number, e.g. ``'1,000.50'`` becomes ``'1000.5'``."""
+    cleaned = text.replace(',', '').replace(' ', '').replace("'", '')
+    if '.' in cleaned:
+        cleaned = cleaned.rstrip('0').rstrip('.')
+    return cleaned.lstrip('0') or '0'
+
+
+# per unit: the suffix after the number, the compiled lookbehind in front of
+# it or None, and the keywords the suffix starts with, mapped to the
+# characters that can't come right after them
+_UNIT_PATTERNS = {}
+
+
+def _unit_pattern(unit, regex):
+    """Split a unit pattern for the scanner and keywords, once per unit."""
+    if unit not in _UNIT_PATTERNS:
+        prefix, suffix = regex.pattern.split(RE_NUM)
+        prefix = re.compile(prefix, flags=RE_FLAGS) if prefix else None
+        keywords = {}
+        for keyword, is_open, excluded in _pattern_prefixes(sre_parse.parse(suffix), _KEYWORD_LENGTH + 1):
+            # a keyword that can follow a space keeps it, 'in' isn't ' in'
+            cut = keyword[:len(keyword) - len(keyword.lstrip(' ')) + _KEYWORD_LENGTH]
+            if cut != keyword:
+                excluded = _NO_CHARS
+            keywords[cut] = keywords[cut] & excluded if cut in keywords else excluded
+        _UNIT_PATTERNS[unit] = suffix, prefix, keywords
+    return _UNIT_PATTERNS[unit]
+
+
+def _compile_scanner(table):
+    """
+    Combine the unit suffixes of all unit patterns of the table into a single
+    regex, matched right after every number found by `_numbers`.
+
+    Every suffix is tried in its own lookahead, so one match reports all
+    units following a number, exactly like running each unit pattern on its
+    own would. Suffixes never start with a digit or a separator, so only the
+    longest number at a position can be followed by a unit.
+
+    Returns the regex and a list of ``(group, category, unit, prefix)``, where
+    `prefix` is the compiled lookbehind in front of the number of a unit
+    pattern, or None.
+
+    """
+    suffixes = []
+    groups = []
+    group = 1
+    for category, units in table.items():
+        for unit, (regex, factor) in units.items():
+            suffix, prefix, keywords = _unit_pattern(unit, regex)
+            suffixes.append('(?=({})|)'.format(suffix))
+            groups.append((group, category, unit, prefix))
+            group += re.compile(suffix).groups + 1
+    scanner = re.compile(''.join(suffixes), flags=RE_FLAGS)
+    return scanner, groups
+
+
+# the combined regex of all unit suffixes, its groups, the keywords for the
+# prefilter and the blacklist index are built on first use by
+# _compile_matcher(), and again after a category was registered
+SCANNER = None
+SCANNER_GROUPS = None
+KEYWORDS = None
+KEYWORD_RULES = None
+BLACKLIST_INDEX = None
+_matcher_lock = threading.Lock()
+
+_NUMBER_SEPARATORS = ' ,'
+
+# at most this many numbers are looked at per text, the rest is ignored
+MAX_SCAN_NUMBERS = 10000
+
+
+@lru_cache(maxsize=8)
+def _compile_digit_runs(keywords):
+    """
+    Regex for the runs of digits after a word boundary that can be part of
+    a number with a unit: followed by more digits of the number, or by one
+    of the `keywords`. Nothing in it backtracks more than a character.
+
+    """
+    # the lookbehind after the first digit is only tried where there is one,
+    # unlike a \b in front of it
+    runs = r'\d(?<!\w\d)\d*(?!\d)'
+    if keywords == ('',):
+        return re.compile(runs)
+    return re.compile(runs + r'(?=[ ,.]\d|{})'.format('|'.join(map(re.escape, keywords))),
+                      flags=RE_FLAGS)
+
+
+def _numbers(text, keywords=('',)):
+    """
+    Yield the ``(start, end)`` of the numbers in the text, as RE_NUM would
+    match them at every digit after a word boundary, in linear time.
+
+    Digits grouped by thousands, like ``1,234 567``, are only followed as
+    long as every group has three digits, so every run of digits is looked
+    at a fixed number of times however long the groups go on. Runs are
+    only searched for as far as the current number needs, so stopping
+    early doesn't scan the rest of the text. With `keywords`, numbers that
+    can't be followed by one are left out.
+
+    """
+    matches = _compile_digit_runs(keywords).finditer(text)
+    runs = []
+
+    def run(index):
+        """The ``(start, end)`` of a run of digits, None after the last one."""
+        while len(runs) <= index:
+            match = next(matches, None)
+            if match is None:
+                return None
+            runs.append(match.span())
+        return runs[index]
+
+    def run_after(index):
+        """The run right after a run and one character in between, if any."""
+        following = run(index + 1)
+        if following is not None and following[0] == runs[index][1] + 1:
+            return following
+        return None
+
+    # by index of a run, where the thousands groups following it end and
+    # the index of the run they end in
+    group_ends = {}
+
+    index = 0
+    while run(index) is not None:
+        start, end = runs[index]
+        number_end, last = end, index
+        if end - start <= 3 and run_after(index) is not None:
+            chain = []
+            last = index
+            while last not in group_ends:
+                chain.append(last)
+                run_end = runs[last][1]
+                following = run_after(last)
+                if (following is None or text[run_end] not in _NUMBER_SEPARATORS
+                        or following[1] - following[0] < 3):
+                    group_end = run_end, last
+                    break
+                if following[1] - following[0] > 3:
+                    group_end = run_end + 4, last + 1
+                    break
+                # a group of exactly three digits, the next one can follow
+                last += 1
+            else:
+                group_end = group_ends[last]
+            for member in chain:
+                group_ends[member] = group_end
+            number_end, last = group_ends[index]
+
+        if text.startswith('.', number_end) and number_end == runs[last][1]:
+            decimals = run_after(last)
+            if decimals is not None:
+                number_end = decimals[1]
+        yield start, number_end
+        index += 1
+
+
+def _scan(text):
+    """
+    Yield ``(category, unit, match_text, number, span)`` for every position
+    in the text where a unit pattern matches.
+
+    """
+    if SCANNER is None:
+        _compile_matcher()
+    return _scan_matches(text, SCANNER, SCANNER_GROUPS, KEYWORDS)
+
+
+def _scan_numbers(text, scanner, keywords=('',)):
+    """Yield ``(start, number, match)`` for the numbers followed by a unit suffix."""
+    for count, (start, end) in enumerate(_numbers(text, keywords)):
+        if count == MAX_SCAN_NUMBERS:
+            logger.warning('Stopped looking for units after {} numbers.'.format(count))
+            return
+        match = scanner.match(text, end)
+        if match.lastindex is not None:
+            yield start, text[start:end], match
+
+
+def _scan_matches(text, scanner, scanner_groups, keywords=('',)):
+    for start, number, match in _scan_numbers(text, scanner, keywords):
+        for group, category, unit, prefix in scanner_groups:
+            end = match.end(group)
+            if end == -1 or prefix is not None and not prefix.match(text, start):
+                continue
+            yield category, unit, text[start:end], number, (start, end)
+
+
+def _compile_blacklist(entries, scanner, scanner_groups):
+    """
+    Build a set of ``(number, unit)`` keys from blacklist entries.
+
+    Each entry is parsed like a comment, so "10ft" also covers "10 ft" and
+    "10 feet". Entries that aren't a single unit are logged and skipped.
+
+    """
+    index = set()
+    for entry in entries:
+        entry = entry.strip()
+        keys = {(_num_key(number), unit)
+                for category, unit, match_text, number, span
+                in _scan_matches(entry, scanner, scanner_groups)
+                if span == (0, len(entry))}
+        if not keys:
+            logger.warning('Ignoring blacklist entry {!r}, no unit found.'.format(entry))
+        index.update(keys)
+    return frozenset(index)
+
+
+# entries of the file loaded by load_blacklist()
+_BLACKLIST_FILE_ENTRIES = []
+
+
+def load_blacklist(path):
+    """
+    Replace the blacklist index with BLACKLIST and the entries of a file.
+
+    The file has one entry per line, empty lines and lines starting with
+    ``#`` are ignored. Call it again to reload the file.
+
+    """
+    global BLACKLIST_INDEX, _BLACKLIST_FILE_ENTRIES
+    with io.open(path, encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    entries = [line for line in lines if line and not line.startswith('#')]
+    if SCANNER is None:
+        _compile_matcher()
+    _BLACKLIST_FILE_ENTRIES = entries
+    BLACKLIST_INDEX = _compile_blacklist(BLACKLIST + entries, SCANNER, SCANNER_GROUPS)
+    logger.info('Loaded {} blacklist entries from {}.'.format(len(entries), path))
+
+
+# scanner groups in order of how often their unit was detected
+_DETECT_GROUPS = None
+_UNIT_HITS = Counter()
+_DETECT_SORT_INTERVAL = 256
+
+
+def _detect(text):
+    """
+    Whether the text has a unit `iter_units` would yield.
+
+    Stops at the first unit that isn't blacklisted or zero, both checked on
+    the number as written without parsing it. Units are tried in order of
+    their hits so far, so the common ones are confirmed first.
+
+    """
+    global _DETECT_GROUPS
+    if SCANNER is None:
+        _compile_matcher()
+    groups = _DETECT_GROUPS
+    ends = {}
+    for start, number, match in _scan_numbers(text, SCANNER, KEYWORDS):
+        key = _num_key(number)
+        if key == '0' or not key.isascii() and not _parse_num(key):
+            continue
+
+        for group, category, unit, prefix in groups:
+            end = match.end(group)
+            if end == -1 or prefix is not None and not prefix.match(text, start):
+                continue
+            if start < ends.get(unit, 0):
+                continue
+            ends[unit] = end
+            if (key, unit) in BLACKLIST_INDEX:
+                continue
+
+            _UNIT_HITS[unit] += 1
+            if sum(_UNIT_HITS.values()) % _DETECT_SORT_INTERVAL == 0:
+                _DETECT_GROUPS = sorted(groups, key=lambda group: -_UNIT_HITS[group[2]])
+            return True
+    return False
+
+
+# characters a number can consist of after the first digit, separators only
+# when another digit follows them
+_NUMBER_CHARS = '0123456789., '
+_ASCII = frozenset(chr(i) for i in range(128))
+_NO_CHARS = frozenset()
+# what \b rules out after a letter, ASCII only as there's no end to the others
+_WORD_CHARS = frozenset('abcdefghijklmnopqrstuvwxyz0123456789_')
+_DIGITS_TO_ZERO = {ord(digit): '0' for digit in '123456789'}
+
+
+def _set_chars(av, size):
+    """The lowercase characters of a parsed character set, None for sets too large to list."""
+    chars = set()
+    for set_op, set_av in av:
+        if set_op == sre_constants.LITERAL:
+            chars.add(chr(set_av).lower())
+        elif set_op == sre_constants.RANGE and set_av[1] - set_av[0] < size:
+            chars.update(chr(c).lower() for c in range(set_av[0], set_av[1] + 1))
+        else:
+            return None
+    return chars
+
+
+def _pattern_prefixes(items, length):
+    """
+    Return the set of prefixes of up to `length` characters any text matched
+    by the parsed pattern `items` must start with.
+
+    Prefixes are returned as ``(prefix, open, excluded)`` tuples, `open`
+    telling whether the following items can still extend the prefix, and
+    `excluded` the characters that can't come right after it, from negated
+    sets, lookaheads and word boundaries.
+
+    """
+    prefixes = {('', True, _NO_CHARS)}
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            options = {(chr(av).lower(), True, _NO_CHARS)}
+        elif op == sre_constants.NOT_LITERAL:
+            options = {('', False, frozenset([chr(av).lower()]))}
+        elif op == sre_constants.IN and av[0][0] == sre_constants.NEGATE:
+            options = {('', False, frozenset(_set_chars(av[1:], 26) or ()))}
+        elif op == sre_constants.IN:
+            chars = _set_chars(av, 10)
+            options = {(c, True, _NO_CHARS) for c in chars} if chars else {('', False, _NO_CHARS)}
+        elif op == sre_constants.ASSERT and av[0] == 1:
+            # a lookahead doesn't move on, but can rule out the next character
+            inner = _pattern_prefixes(av[1], length)
+            excluded = _NO_CHARS
+            if inner and all(not prefix for prefix, is_open, chars in inner):
+                excluded = frozenset.intersection(*[chars for prefix, is_open, chars in inner])
+            options = {('', True, excluded)}
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            options = {('', True, _NO_CHARS)}
+        elif op == sre_constants.SUBPATTERN:
+            options = _pattern_prefixes(av[-1], length)
+        elif op == sre_constants.BRANCH:
+            options = set()
+            for branch in av[1]:
+                options |= _pattern_prefixes(branch, length)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            low, high, item = av
+            options = _pattern_prefixes(item, length)
+            if high != 1:
+                options = {(prefix, False, excluded) for prefix, is_open, excluded in options}
+            if low == 0:
+                options.add(('', True, _NO_CHARS))
+        else:
+            options = {('', False, _NO_CHARS)}
+
+        extended = set()
+        for prefix, is_open, excluded in prefixes:
+            if not is_open:
+                extended.add((prefix, False, excluded))
+                continue
+            if op == sre_constants.AT and av == sre_constants.AT_BOUNDARY and prefix[-1:].isalnum():
+                excluded |= _WORD_CHARS
+            for option, option_open, option_excluded in options:
+                if option[:1] in excluded:
+                    continue
+                combined = prefix + option
+                if len(combined) > length:
+                    extended.add((combined[:length], False, _NO_CHARS))
+                    continue
+                if not option:
+                    option_excluded |= excluded
+                extended.add((combined, option_open and len(combined) < length, option_excluded))
+        prefixes = extended
+    return prefixes
+
+
+_KEYWORD_LENGTH = 7
+
+
+def _lookbehind_chars(prefix):
+    """The characters a number can't follow for the compiled lookbehind `prefix` of a unit."""
+    chars = set()
+    for op, av in sre_parse.parse(prefix.pattern) if prefix is not None else ():
+        if op != sre_constants.ASSERT_NOT or av[0] != -1 or len(av[1]) != 1:
+            return set()
+        set_op, set_av = av[1][0]
+        if set_op == sre_constants.LITERAL:
+            chars.add(chr(set_av).lower())
+        elif set_op == sre_constants.IN and _set_chars(set_av, 10):
+            chars.update(_set_chars(set_av, 10))
+        else:
+            return set()
+    return chars
+
+
+def _compile_keywords(table):
+    """
+    Collect the keywords any unit in the table can start with after its number.
+
+    The keywords are derived from the unit patterns themselves, so a text
+    without a digit followed by one of them can't contain any unit. Keywords
+    that may be written after a space start with one.
+
+    Returns the shortest keywords, and for all of them the characters the
+    number in front can't follow and the characters that can't come after
+    the keyword, like a letter after ``in``.
+
+    """
+    rules = {}
+    for units in table.values():
+        for unit, (regex, factor) in units.items():
+            suffix, prefix, keywords = _unit_pattern(unit, regex)
+            before = _lookbehind_chars(prefix)
+            for keyword, after in keywords.items():
+                if keyword in rules:
+                    rules[keyword] = rules[keyword][0] & before, rules[keyword][1] & after
+                else:
+                    rules[keyword] = frozenset(before), after
+    if any(not keyword.strip(' ') or keyword.lstrip(' ')[0] in _NUMBER_CHARS for keyword in rules):
+        # some unit can't be told apart from its number, check every digit
+        return ('',), {'': (_NO_CHARS, _NO_CHARS)}
+    # 'mi' already covers 'mil' and 'min'
+    return tuple(sorted(keyword for keyword in rules
+                        if not any(keyword != other and keyword.startswith(other)
+                                   for other in rules))), rules
+
+
+# directory to keep the derived tables in between runs, see _compile_matcher()
+MATCHER_CACHE_DIR = os.environ.get('CONVERTS2USELESS_CACHE')
+
+# bump when the cached tables change
+_MATCHER_CACHE_VERSION = 4
+_matcher_cache = (None, None)
+
+
+def _definitions_key():
+    """Hash of everything the cached tables are built from."""
+    definitions = [
+        _MATCHER_CACHE_VERSION, sys.version_info[:2], RE_NUM, RE_FLAGS, _KEYWORD_LENGTH,
+        [(category, [(unit, regex.pattern, factor) for unit, (regex, factor) in units.items()])
+         for category, units in UNIT_TABLE.items()],
+        [(category, [(names, getattr(factor, '__qualname__', factor)) for names, factor in useless])
+         for category, useless in USELESS_UNITS.items()],
+        BLACKLIST + _BLACKLIST_FILE_ENTRIES,
+    ]
+    return hashlib.sha256(repr(definitions).encode('utf-8')).hexdigest()
+
+
+def _matcher_cache_path(key):
+    return os.path.join(MATCHER_CACHE_DIR, 'matcher-{}.json'.format(key))
+
+
+def _encode_matcher_cache(cached):
+    """The tables as plain JSON, Decimals are kept as strings."""
+    return json.dumps({
+        'scanner': list(cached['scanner']),
+        'scanner_groups': [list(group) for group in cached['scanner_groups']],
+        'keywords': list(cached['keywords']),
+        'keyword_rules': {keyword: [''.join(sorted(before)), ''.join(sorted(after))]
+                          for keyword, (before, after) in cached['keyword_rules'].items()},
+        'blacklist_index': sorted(cached['blacklist_index']),
+        'conversions': [[from_unit, to_unit, str(factor)]
+                        for (from_unit, to_unit), factor in cached['conversions'].items()],
+        'float_conversions': [[from_unit, to_unit, factor]
+                              for (from_unit, to_unit), factor in cached['float_conversions'].items()],
+    }, separators=(',', ':')).encode('utf-8')
+
+
+def _decode_matcher_cache(data):
+    """The tables of `_encode_matcher_cache`, raises ValueError if they're broken."""
+    try:
+        tables = json.loads(data.decode('utf-8'))
+        return {
+            'scanner': tuple(tables['scanner']),
+            'scanner_groups': [tuple(group) for group in tables['scanner_groups']],
+            'keywords': tuple(tables['keywords']),
+            'keyword_rules': {keyword: (frozenset(before), frozenset(after))
+                              for keyword, (before, after) in tables['keyword_rules'].items()},
+            'blacklist_index': frozenset(tuple(key) for key in tables['blacklist_index']),
+            'conversions': {(from_unit, to_unit): Decimal(factor)
+                            for from_unit, to_unit, factor in tables['conversions']},
+            'float_conversions': {(from_unit, to_unit): factor
+                                  for from_unit, to_unit, factor in tables['float_conversions']},
+        }
+    except (KeyError, TypeError, ArithmeticError) as e:
+        raise ValueError('broken matcher cache: {!r}'.format(e))
+
+
+def _load_matcher_cache():
+    """The cached tables for the current definitions, or None."""
+    global _matcher_cache
+    if not MATCHER_CACHE_DIR:
+        return None
+    key = _definitions_key()
+    if _matcher_cache[0] == key:
+        return _matcher_cache[1]
+    try:
+        with open(_matcher_cache_path(key), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                cached = _decode_matcher_cache(data[:])
+    except (IOError, OSError, ValueError):
+        return None
+    _matcher_cache = (key, cached)
+    return cached
+
+
+def _save_matcher_cache(cached):
+    """Write the tables to the cache directory, replacing the file atomically."""
+    key = _definitions_key()
+    path = _matcher_cache_path(key)
+    try:
+        if not os.path.isdir(MATCHER_CACHE_DIR):
+            os.makedirs(MATCHER_CACHE_DIR)
+        temp_path = '{}.{}'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(_encode_matcher_cache(cached))
+        os.replace(temp_path, path)
+    except (IOError, OSError):
+        logger.warning('Could not write the matcher cache to {}.'.format(path), exc_info=True)
+
+
+def _compile_matcher():
+    """
+    Build SCANNER and everything derived from it for all registered units.
+
+    With a MATCHER_CACHE_DIR, the keywords, blacklist index and patterns are
+    read from a file for the current unit definitions, so only the regexes
+    themselves have to be compiled again.
+
+    """
+    global SCANNER, SCANNER_GROUPS, KEYWORDS, KEYWORD_RULES, BLACKLIST_INDEX, _DETECT_GROUPS
+    with _matcher_lock:
+        if SCANNER is not None:
+            return
+        cached = _load_matcher_cache()
+        if cached is not None:
+            pattern, flags = cached['scanner']
+            scanner = re.compile(pattern, flags)
+            scanner_groups = [(group, category, unit, prefix and re.compile(prefix, flags=RE_FLAGS))
+                              for group, category, unit, prefix in cached['scanner_groups']]
+            keywords = cached['keywords']
+            keyword_rules = cached['keyword_rules']
+            blacklist_index = cached['blacklist_index']
+        else:
+            scanner, scanner_groups = _compile_scanner(UNIT_TABLE)
+            keywords, keyword_rules = _compile_keywords(UNIT_TABLE)
+            blacklist_index = _compile_blacklist(BLACKLIST + _BLACKLIST_FILE_ENTRIES,
+                                                 scanner, scanner_groups)
+            if MATCHER_CACHE_DIR:
+                _save_matcher_cache({
+                    'scanner': (scanner.pattern, scanner.flags),
+                    'scanner_groups': [(group, category, unit, prefix and prefix.pattern)
+                                       for group, category, unit, prefix in scanner_groups],
+                    'keywords': keywords,
+                    'keyword_rules': keyword_rules,
+                    'blacklist_index': blacklist_index,
+                    'conversions': CONVERSIONS,
+                    'float_conversions': _FLOAT_CONVERSIONS,
+                })
+
+        SCANNER_GROUPS = scanner_groups
+        KEYWORDS = keywords
+        KEYWORD_RULES = keyword_rules
+        BLACKLIST_INDEX = blacklist_index
+        _DETECT_GROUPS = sorted(scanner_groups, key=lambda group: -_UNIT_HITS[group[2]])
+        SCANNER = scanner
+
+
+def register_category(category, units, useless_units=(), names=None, chains=()):
+    """
+    Add a unit category, e.g. from a module of its own.
+
+    `units` is a list of ``(unit, (regex, factor))`` like the entries of
+    UNIT_TABLE, with regexes made by `r`. `useless_units`, `names` and
+    `chains` are added to USELESS_UNITS, NAMES and UNIT_CHAINS. The patterns
+    are compiled when units are looked for the next time.
+
+    """
+    global CHAIN_PREFIXES, SCANNER
+    units = OrderedDict(units)
+    if category in UNIT_TABLE:
+        raise ValueError('category {} is already registered'.format(category))
+    for unit in units:
+        if unit in UNIT_CODES or unit in UNIT_TABLE:
+            raise ValueError('unit {} is already registered'.format(unit))
+
+    UNIT_TABLE[category] = units
+    USELESS_UNITS[category] = list(useless_units)
+    NAMES.update(names or {})
+    if chains:
+        UNIT_CHAINS[category] = [list(chain) for chain in chains]
+        CHAIN_PREFIXES = _chain_prefixes(UNIT_CHAINS)
+    _add_category(category)
+    with _matcher_lock:
+        SCANNER = None
+
+
+# modules and files loaded by load_categories()
+_LOADED_CATEGORIES = set()
+
+
+def load_categories(source):
+    """
+    Register unit categories from a module name or a JSON file.
+
+    Modules register their categories when imported, see fuel_economy.py.
+    JSON files have a list of categories like money.json: units are lists of
+    name, pattern after the number and factor; factors are strings.
+    Loading the same source again does nothing.
+
+    """
+    if source in _LOADED_CATEGORIES:
+        return
+    if not source.endswith('.json'):
+        importlib.import_module(source)
+    else:
+        with io.open(source, encoding='utf-8') as f:
+            categories = json.load(f)
+        for category in categories:
+            register_category(
+                category['category'],
+                [(unit, (r(pattern), Decimal(factor))) for unit, pattern, factor in category['units']],
+                useless_units=[(names, Decimal(factor)) for names, factor in category.get('useless_units', [])],
+                names=category.get('names'),
+                chains=category.get('chains', ()),
+            )
+    _LOADED_CATEGORIES.add(source)
+
+
+def _init_categories():
+    """Add the conversions and unit codes of the built-in categories."""
+    cached = _load_matcher_cache()
+    for category in UNIT_TABLE:
+        _add_category(category, conversions=cached is None)
+    if cached is not None:
+        CONVERSIONS.update(cached['conversions'])
+        _FLOAT_CONVERSIONS.update(cached['float_conversions'])
+
+
+_init_categories()
+
+
+def _prettify(value, places, sep, dp, pos, neg):
+    formatted = '{:+,.{}f}'.format(value, places)
+    formatted = (neg if formatted[0] == '-' else pos) + formatted[1:].translate({
+        ord(','): sep,
+        ord('.'): dp,
+    })
 
     if value < 1:
         pass
     elif value < 10:
-        result = result[places - 2:]
+        formatted = formatted[:len(formatted) - places + 2]
     elif value > 99000000:
-        result = [' million'] + result[9 + places:]
+        formatted = formatted[:len(formatted) - places - 9] + ' million'
     else:
-        result = result[places + 1:]
+        formatted = formatted[:len(formatted) - places - 1]
 
-    formatted = ''.join(reversed(result))
     if '.' in formatted:
         return formatted.rstrip('.0')
     return formatted
 
 
+_cached_prettify = lru_cache(maxsize=1024, typed=True)(_prettify)
+
+
+def prettify(value, places=6, sep=',', dp='.', pos='', neg='-'):
+    """
+    Format a number for a reply, e.g. ``1,234``, ``3.14`` or ``120 million``.
+
+    Values below 1 keep `places` decimal places, below 10 two of them and
+    anything larger none, trailing zeros are trimmed. Results are cached.
+
+    """
+    if not value:
+        # 0 and -0 are the same to the cache but not formatted the same
+        return _prettify(value, places, sep, dp, pos, neg)
+    return _cached_prettify(value, places, sep, dp, pos, neg)
+
+
 class Unit(object):
     """
     A unit that knows how to convert and normalize itself.
 
+    Units are kept compact for large batches: there's no instance dict,
+    category and unit are the shared constants of this module, and the
+    normal value is only computed once when it's first needed.
+
     """
-    def __init__(self, category, value, unit=None, original=None):
+    __slots__ = ('category', 'value', 'unit', 'original', 'start', 'end', '_normal_value')
+
+    def __init__(self, category, value, unit=None, original=None, span=None):
         if category not in UNIT_TABLE.keys():
             raise TypeError('unknown unit category {}'.format(category))
         self.category = category
         if isinstance(value, int):
-            value = Decimal(value)
+            value = _number(value)
         self.value = value
         self.unit = unit
         self.original = original
+        self.start, self.end = span or (None, None)
+        self._normal_value = None
 
     def __repr__(self):
         if self.is_original():
             fmt = '<Unit(category={category!r}, value={value!r}, unit={unit!r})>'
         else:
             fmt = '<Unit(category={category!r}, value={value!r}, original={original!r})>'
-        return fmt.format(**self.__dict__)
+        return fmt.format(category=self.category, value=self.value,
+                          unit=self.unit, original=self.original)
 
     def __str__(self):
         if self.unit is None:
@@ -296,16 +1097,19 @@ class Unit(object):
         if not isinstance(other, self.__class__):
             return False
 
-        normal = self.to_normal()
-        other = other.to_normal()
-        sig_figs = max(normal.value.as_tuple()[2], other.value.as_tuple()[2])
+        if self.category != other.category:
+            return False
+
+        normal_val = _as_decimal(self.normal_value)
+        other_val = _as_decimal(other.normal_value)
+        sig_figs = max(normal_val.as_tuple()[2], other_val.as_tuple()[2])
         quantum = Decimal('10') ** sig_figs
-        normal_val = normal.value.quantize(quantum)
-        other_val = other.value.quantize(quantum)
+        normal_val = normal_val.quantize(quantum)
+        other_val = other_val.quantize(quantum)
 
         if normal_val.normalize() == Decimal('0e0'):
             return False
-        return normal.category == other.category and other_val == normal_val
+        return other_val == normal_val
 
     def format_unit(self):
         name = choice(NAMES[self.unit])
@@ -327,93 +1131,212 @@ class Unit(object):
     def is_normal(self):
         return self.unit is None
 
+    @property
+    def span(self):
+        """Position of the unit in the text it was found in, if any."""
+        if self.start is None:
+            return None
+        return self.start, self.end
+
+    @property
+    def normal_value(self):
+        """The value in the normal unit of the category."""
+        if self._normal_value is None:
+            if self.is_normal():
+                self._normal_value = self.value
+            else:
+                self._normal_value = convert(self.value, self.unit, self.category)
+        return self._normal_value
+
     def to_normal(self):
         if self.is_normal():
             return self
-
-        normal_value = self.value * UNIT_TABLE[self.category][self.unit][1]
-        return Unit(self.category, normal_value, original=self)
+        return Unit(self.category, self.normal_value, original=self)
 
     def to_useless(self):
         """Convert the value to a randomly selected useless unit."""
-        if self.is_original():
-            return self.to_normal().to_useless()
-
         names, factor = choice(USELESS_UNITS[self.category])
+        name = choice(names)
         if callable(factor):
-            value = factor(self.value)
+            value = factor(self.normal_value)
         else:
-            value = self.value * factor
-        return '{} {}'.format(prettify(value), choice(names))
+            value = convert(self.value, self.unit or self.category, name)
+        return '{} {}'.format(prettify(value), name)
 
     @staticmethod
     def find_units(text):
-        for category, units in UNIT_TABLE.items():
-            look_for_chains = category in UNIT_CHAINS
-            current_chain = None
-            chain_units = []
-
-            for unit, (regex, factor) in units.items():
-                match = regex.search(text)
-                if not match or match.group(0).lower().strip() in BLACKLIST:
-                    continue
-
-                raw_value = _parse_num(match.group(1))
-
-                if raw_value <= 0:
+        """
+        Yield the units in the text in order of appearance.
+
+        Adjacent units that make up a chain like 5'4" or 1 hour 3 minutes are
+        merged into a list, only separated by whitespace or CHAIN_WORDS. Units
+        are swept once in order, so a text can have any number of chains.
+
+        """
+        chain = []
+        chain_units = ()
+        for unit_instance in Unit.iter_units(text):
+            if chain:
+                start = unit_instance.start
+                end = chain[-1].end
+                next_units = chain_units + (unit_instance.unit,)
+                if (start >= end and next_units in CHAIN_PREFIXES
+                        and text[end:start].lower().strip() in _CHAIN_GAPS):
+                    chain.append(unit_instance)
+                    chain_units = next_units
                     continue
 
-                unit_instance = Unit(category, raw_value, unit=unit)
+                if len(chain) > 1:
+                    yield chain
+                else:
+                    yield chain[0]
 
-                if look_for_chains:
-                    current_chain = _get_chain(category, unit, len(chain_units))
+            chain_units = (unit_instance.unit,)
+            if chain_units in CHAIN_PREFIXES:
+                chain = [unit_instance]
+            else:
+                chain = []
+                yield unit_instance
 
-                if current_chain and unit == current_chain[len(chain_units)]:
-                    chain_units.append((unit_instance, match))
+        if len(chain) > 1:
+            yield chain
+        elif chain:
+            yield chain[0]
 
-                elif not chain_units:
-                    yield unit_instance
+    @staticmethod
+    def iter_units(text):
+        """
+        Yield every unit in the text in order of appearance.
+
+        Units are found lazily in a single pass, each one knows the `span` of
+        the text it was found in. Blacklisted and zero values are skipped, so
+        are matches overlapping an earlier match of the same unit.
+
+        """
+        ends = {}
+        for category, unit, match_text, number, span in _scan(text):
+            if span[0] < ends.get(unit, 0):
+                continue
+            ends[unit] = span[1]
 
-            if chain_units:
-                if Unit._valid_chain(text, chain_units):
-                    yield list(map(lambda u: u[0], chain_units))
-                else:
-                    for chain_unit, match in chain_units:
-                        yield chain_unit
+            if (_num_key(number), unit) in BLACKLIST_INDEX:
+                continue
 
-    @staticmethod
-    def _valid_chain(text, chain):
-        """Verify chains that the units are adjacent to each other."""
-        if len(chain) < 2:
-            return False
+            raw_value = _parse_num(number)
 
-        offset = -1
-        for unit, match in chain:
-            if offset == -1:
-                offset = match.end()
+            if raw_value <= 0:
                 continue
 
-            gap_word = text[offset:match.start()].lower().strip()
+            yield Unit(category, raw_value, unit=unit, span=span)
 
-            if gap_word and gap_word not in CHAIN_WORDS:
-                return False
-            offset = match.end()
-        return True
+    @staticmethod
+    def find_units_batch(texts):
+        """
+        Find the units in many texts at once.
+
+        Returns a `UnitBatch` of columns with one row per unit: the index of
+        its text, category, unit, value, normalized value and span. Values
+        are normalized in one vectorized step; the columns are NumPy arrays
+        if NumPy is installed, lists otherwise.
+
+        """
+        global _NORMAL_FACTORS_ARRAY
+        index, categories, units, values, starts, ends = [], [], [], [], [], []
+        for i, text in enumerate(texts):
+            if not Unit.may_have_units(text):
+                continue
+            for unit_instance in Unit.iter_units(text):
+                index.append(i)
+                categories.append(unit_instance.category)
+                units.append(unit_instance.unit)
+                values.append(unit_instance.value)
+                starts.append(unit_instance.start)
+                ends.append(unit_instance.end)
+
+        codes = [UNIT_CODES[unit] for unit in units]
+        numpy = _import_numpy()
+        if numpy is None:
+            factors = _FLOAT_NORMAL_FACTORS if _number is float else _NORMAL_FACTORS
+            normal = [value * factors[code] for value, code in zip(values, codes)]
+            return UnitBatch(index, categories, units, values, normal, starts, ends)
+
+        if _NORMAL_FACTORS_ARRAY is None:
+            _NORMAL_FACTORS_ARRAY = numpy.array(_FLOAT_NORMAL_FACTORS)
+        values = numpy.array(values, dtype=float)
+        normal = values * _NORMAL_FACTORS_ARRAY[numpy.array(codes, dtype=int)]
+        return UnitBatch(
+            numpy.array(index, dtype=int),
+            numpy.array(categories, dtype=object),
+            numpy.array(units, dtype=object),
+            values,
+            normal,
+            numpy.array(starts, dtype=int),
+            numpy.array(ends, dtype=int),
+        )
 
     @staticmethod
     def find_normalized(text):
-        units = list(Unit.find_units(text))
+        return Unit.normalize(list(Unit.find_units(text)))
+
+    @staticmethod
+    def normalize(units):
+        """Normalize units as found by `find_units`, adding up chains."""
         for original in units:
             if isinstance(original, list):
-                normal = reduce(lambda v, o: v + o.to_normal().value, original, Decimal())
+                normal = sum(o.normal_value for o in original)
                 yield Unit(original[0].category, normal, original=original)
             else:
                 yield original.to_normal()
 
+    @staticmethod
+    def may_have_units(text):
+        """
+        Cheap check whether a text can contain units at all.
+
+        Looks for a digit that is followed by a unit keyword using plain
+        string operations only, along with the characters around them the
+        unit patterns rule out. False means there are definitely no units.
+
+        """
+        if SCANNER is None:
+            _compile_matcher()
+        strict = text.isascii()
+        if strict:
+            text = text.lower()
+        elif any(c.isdecimal() for c in set(text).difference(_ASCII)):
+            # digits outside of ASCII, leave it to the regexes
+            return True
+        else:
+            # casefolding can change the characters around a keyword, so
+            # only the keywords themselves are checked
+            text = text.casefold()
+
+        # all digits become zeros, so finding the next one is a single find()
+        zeroed = text.translate(_DIGITS_TO_ZERO)
+        length = len(zeroed)
+        start = zeroed.find('0')
+        while start != -1:
+            end = start + 1
+            while end < length and (zeroed[end] == '0' or zeroed[end] in _NUMBER_CHARS
+                                    and zeroed.startswith('0', end + 1)):
+                end += 1
+            if text.startswith(KEYWORDS, end):
+                if not strict:
+                    return True
+                # without separators, the number can only start at the first digit
+                before = text[start - 1] if start and zeroed.count('0', start, end) == end - start else None
+                for size in range(_KEYWORD_LENGTH + 2):
+                    rule = KEYWORD_RULES.get(text[end:end + size])
+                    if rule is not None and before not in rule[0] and text[end + size:end + size + 1] not in rule[1]:
+                        return True
+            start = zeroed.find('0', end)
+        return False
+
     @staticmethod
     def find_first_unit(text):
         return next(Unit.find_units(text), None)
 
     @staticmethod
     def has_units(text):
-        return Unit.find_first_unit(text) is not None
+        """Whether the text has any units, without parsing them."""
+        return Unit.may_have_units(text) and _detect(text)